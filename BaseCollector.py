@@ -1,16 +1,40 @@
 from abc import ABC, abstractmethod
-from modules.Connection import Connection, TIMEOUT
+from modules.Connection import Connection, TIMEOUT, PAGE_SIZE
+from modules.AsyncConnection import AsyncConnection, MAX_CONCURRENT_REQUESTS
+from modules.Topology import TopologyCache, TOPOLOGY_TTL, fabric_node
+from modules.HostSelector import PROBE_INTERVAL
+from modules.Transport import CONNECTION_POOL_SIZE
+from modules.Deadline import carry_budget
+from modules.Outcome import mark_incomplete
+from modules.Subscription import SubscriptionManager, SubscriptionStore, SUBSCRIPTION_RESYNC
+import itertools
 import logging
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 LOG = logging.getLogger('apic_exporter.exporter')
 
 
 class BaseCollector(ABC):
     def __init__(self, config: Dict):
-        self.hosts: List[str] = config['apic_hosts'].split(',')
-        self.__connection = Connection(self.hosts, config['apic_user'],
-                                       config['apic_password'])
+        hosts: List[str] = config['apic_hosts'].split(',')
+        self.__connection = Connection(hosts, config['apic_user'],
+                                       config['apic_password'], type(self).__name__,
+                                       int(config.get('connection_pool_size', CONNECTION_POOL_SIZE)),
+                                       bool(config.get('compression', True)))
+        self.__connection.selector.start_probing(self.__connection.probe,
+                                                 int(config.get('host_probe_interval', PROBE_INTERVAL)))
+        self.__config = config
+        self.__configured_hosts = hosts
+        self.__async_connection = None
+        self.page_size = int(config.get('page_size', PAGE_SIZE))
+        self.topology = TopologyCache(hosts, self.__connection,
+                                      int(config.get('topology_ttl', TOPOLOGY_TTL)),
+                                      bool(config.get('topology_refresh', False)))
+
+    @property
+    def hosts(self) -> List[str]:
+        """All APIC hosts, the healthy ones first ordered by their response time"""
+        return self.__connection.selector.ranked()
 
     @abstractmethod
     def describe(self):
@@ -34,10 +58,87 @@ class BaseCollector(ABC):
             return None
         return fetched_data
 
-    def reset_unavailable_hosts(self):
-        """Reset the list of unavailable hosts. Move the previously unavailable host to the end of the list"""
-        unresponsive_hosts = self.__connection.get_unresponsive_hosts()
-        for host in unresponsive_hosts:
-            self.hosts.remove(host)
-            self.hosts.append(host)
-        self.__connection.reset_unavailable_hosts()
+    def get_fabric_nodes(self, host: str, role: str = None) -> List[fabric_node]:
+        """Returns the fabric nodes from the shared topology cache, fetched from host when expired
+           Returns None if the host did not respond
+        """
+        return self.topology.get_nodes(host, role)
+
+    def query_host_stream(self, host: str, query: str, timeout: int = TIMEOUT) -> Dict:
+        """Executes the query against a specific APIC host and decodes the response while it is read
+           Returns the fetched data with imdata as an iterator or None if fetched data is invalid
+        """
+        fetched_data = self.__connection.getRequestStream(host, query, timeout)
+        if fetched_data is None:
+            return None
+        if not self.__connection.isDataValid(fetched_data):
+            LOG.warning(
+                "Apic host %s, %s did not return anything", host,
+                query)
+            return None
+        return fetched_data
+
+    def query_host_paged(self, host: str, query: str, timeout: int = TIMEOUT) -> Iterator[Dict]:
+        """Executes the query page by page against a specific APIC host
+           Returns an iterator over the fetched pages or None if the first page is invalid.
+           The iterator raises IncompleteResponse if a later page is invalid.
+        """
+        pages = self.__connection.getPages(host, query, self.page_size, timeout)
+        first_page = next(pages, None)
+        if first_page is None:
+            LOG.warning(
+                "Apic host %s, %s did not return anything", host,
+                query)
+            return None
+        return itertools.chain([first_page], pages)
+
+    @property
+    def async_connection(self) -> AsyncConnection:
+        """The asyncio transport is only set up once a collector awaits a query"""
+        if self.__async_connection is None:
+            self.__async_connection = AsyncConnection(
+                self.__configured_hosts, self.__config['apic_user'], self.__config['apic_password'],
+                int(self.__config.get('max_concurrent_requests', MAX_CONCURRENT_REQUESTS)),
+                type(self).__name__,
+                int(self.__config.get('connection_pool_size', CONNECTION_POOL_SIZE)),
+                bool(self.__config.get('compression', True)))
+        return self.__async_connection
+
+    async def aquery_host(self, host: str, query: str, timeout: int = TIMEOUT) -> Dict:
+        """Awaitable variant of query_host using the asyncio transport
+           Returns the fetched data or None if fetched data is invalid
+        """
+        fetched_data = await self.async_connection.getRequest(host, query, timeout)
+        if fetched_data is None:
+            return None
+        if not self.async_connection.isDataValid(fetched_data):
+            LOG.warning(
+                "Apic host %s, %s did not return anything", host,
+                query)
+            return None
+        return fetched_data
+
+    def subscribe(self, query: str) -> SubscriptionStore:
+        """Returns the store of the query that is kept up to date by the APIC websocket events"""
+        manager = SubscriptionManager(self.__configured_hosts, self.async_connection,
+                                      int(self.__config.get('subscription_resync', SUBSCRIPTION_RESYNC)))
+        return manager.subscribe(query)
+
+    def query_host_subscribed(self, host: str, query: str, timeout: int = TIMEOUT) -> Iterator[Dict]:
+        """Returns the objects of the subscribed query from the local store as a single page
+           Falls back to fetching the pages from the host as long as the subscription is not in sync
+        """
+        store = self.subscribe(query)
+        if store.synced:
+            LOG.debug("Using %s subscribed on %s", query, store.host)
+            return iter([store.get_page()])
+        return self.query_host_paged(host, query, timeout)
+
+    def run_async(self, coro):
+        """Runs the coroutine on the APIC event loop within the deadline of the collection and returns its
+           result"""
+        return self.async_connection.run(carry_budget(coro))
+
+    def mark_incomplete(self, reason: str):
+        """Flags the current collection incomplete, so a cached collector keeps its previous result set"""
+        mark_incomplete(reason)
@@ -4,23 +4,33 @@ from typing import Dict, List
 from prometheus_client.core import Summary
 from prometheus_client.metrics_core import Metric
 from BaseCollector import BaseCollector
+from modules.Transport import IncompleteResponse
 
 LOG = logging.getLogger('apic_exporter.exporter')
+# the processing time is shared by the instances of a collector for different fabrics
+REQUEST_TIMES: Dict[str, Summary] = {}
 
 
 class Collector(BaseCollector):
+    # decode the response of get_query one imdata object at a time instead of loading it at once
+    stream_query = False
+
     def __init__(self, name: str, config: Dict):
         super().__init__(config)
         self.__name = name
-        self.__request_time = Summary('{name}_processing_seconds'.format(name=self.__name),
-                                      'Time spend processing request')
+        if name not in REQUEST_TIMES:
+            REQUEST_TIMES[name] = Summary('{name}_processing_seconds'.format(name=self.__name),
+                                          'Time spend processing request')
+        self.__request_time = REQUEST_TIMES[name]
 
     @abstractmethod
     def get_query(self) -> str:
+        """Returns the query to be executed or None if get_metrics fetches its data itself"""
         pass
 
     @abstractmethod
     def get_metrics(self, host: str, data: Dict) -> List[Metric]:
+        """Creates the metrics from the fetched data. Returning None tries the next host"""
         pass
 
     def collect(self):
@@ -29,16 +39,29 @@ class Collector(BaseCollector):
         with self.__request_time.time():
             LOG.debug('Collecting %s metrics ...', self.__name)
             for host in self.hosts:
-                fetched_data = self.query_host(host, self.get_query())
-                if fetched_data is None:
-                    LOG.warning("Skipping apic host %s did not return anything for %s", host, self.get_query())
+                query = self.get_query()
+                if query is None:
+                    # the subclass fetches everything itself, e.g. from the topology cache
+                    fetched_data = None
+                elif self.stream_query:
+                    fetched_data = self.query_host_stream(host, query)
+                else:
+                    fetched_data = self.query_host(host, query)
+                if query is not None and fetched_data is None:
+                    LOG.warning("Skipping apic host %s did not return anything for %s", host, query)
+                    continue
+                try:
+                    metrics = self.get_metrics(host, fetched_data)
+                except IncompleteResponse as e:
+                    LOG.warning("Skipping apic host %s: %s", host, e)
                     continue
-                metrics = self.get_metrics(host, fetched_data)
                 if metrics is None:
                     continue
                 for metric in metrics:
                     yield metric
                     metric_counter += len(metric.samples)
                 break  # all hosts produce the same metrics, hence querying one is sufficient
+            else:
+                self.mark_incomplete("no apic host returned the %s metrics" % self.__name)
             LOG.info('Collected %s %s metrics', metric_counter, self.__name)
             return
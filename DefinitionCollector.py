@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+from BaseCollector import BaseCollector
+from Collector import REQUEST_TIMES
+from prometheus_client.core import Summary
+from modules.Definitions import MetricDefinition
+from modules.Topology import fabric_node
+
+LOG = logging.getLogger('apic_exporter.exporter')
+
+
+class DefinitionCollector(BaseCollector):
+    def __init__(self, name: str, config: Dict, definitions: List[Dict], query_mode: str = 'class'):
+        """Collects the metrics of declarative definitions, which are compiled once. The queries of all
+           definitions are issued concurrently. In query_mode 'node' definitions with a node_query are
+           queried per fabric node instead of with a single class query"""
+        super().__init__(config)
+        self.__name = name
+        self.__definitions = [MetricDefinition(definition) for definition in definitions]
+        self.__node_mode = query_mode == 'node'
+        if name not in REQUEST_TIMES:
+            REQUEST_TIMES[name] = Summary('{name}_processing_seconds'.format(name=name),
+                                          'Time spend processing request')
+        self.__request_time = REQUEST_TIMES[name]
+
+    def describe(self):
+        for definition in self.__definitions:
+            yield from definition.describe()
+
+    def collect(self):
+        metric_counter = 0
+        with self.__request_time.time():
+            LOG.debug('Collecting %s metrics ...', self.__name)
+            metrics = [definition.create_metrics() for definition in self.__definitions]
+            for host in self.hosts:
+                nodes: Dict[str, fabric_node] = {}
+                if any(definition.needs_nodes for definition in self.__definitions):
+                    fabric_nodes = self.get_fabric_nodes(host)
+                    if fabric_nodes is None:
+                        LOG.warning("Skipping apic host %s, fabric nodes are not available", host)
+                        continue
+                    nodes = {node.id: node for node in fabric_nodes}
+
+                queries = [(index, query) for index, definition in enumerate(self.__definitions)
+                           for query in definition.queries(list(nodes.values()), self.__node_mode)]
+                results = self.run_async(self._fetch(host, queries))
+                if queries and all(result is None for _, result in results):
+                    LOG.warning("Skipping apic host %s, no definition query returned anything", host)
+                    continue
+
+                if any(result is None for _, result in results):
+                    self.mark_incomplete("apic host %s did not answer every definition query" % host)
+                for index, fetched_data in results:
+                    if fetched_data is not None:
+                        metric_counter += self.__definitions[index].extract(host, fetched_data['imdata'], nodes,
+                                                                            metrics[index])
+                break  # all hosts produce the same metrics, hence querying one is sufficient
+            else:
+                self.mark_incomplete("no apic host returned the %s metrics" % self.__name)
+
+            for definition_metrics in metrics:
+                for metric in definition_metrics:
+                    yield metric
+            LOG.info('Collected %s %s metrics', metric_counter, self.__name)
+
+    async def _fetch(self, host: str, queries: List[Tuple[int, str]]) -> List[Tuple[int, Dict]]:
+        """Issue the queries of all definitions concurrently, returns the definition index with each result"""
+        results = await asyncio.gather(*[self.aquery_host(host, query) for _, query in queries])
+        return [(index, result) for (index, _), result in zip(queries, results)]
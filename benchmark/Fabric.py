@@ -0,0 +1,249 @@
+import datetime
+import random
+
+from typing import Dict, Iterator, List, Tuple
+
+CONTROLLER_MODEL = 'APIC-SERVER-M3'
+SPINE_MODEL = 'N9K-C9364C'
+LEAF_MODELS = ['N9K-C93180YC-EX', 'N9K-C93180YC-EX', 'N9K-C93180YC-FX', 'N9K-C9348GC-FXP', 'N9K-C9372PX']
+FAULT_CODES = ['F2533', 'F2534', 'F0532', 'F0546', 'F1394', 'F0103', 'F1296', 'F0321']
+FAULT_LIFECYCLES = ['raised', 'soaking', 'retaining', 'raised-clearing']
+MOD_TS = '2023-01-01T00:00:00.000+00:00'
+# endpoints created by churn_ips get MACs and addresses beyond the generated ones
+CHURNED_ENDPOINTS = 0x800000
+# a change of an object pushed as subscription event: the object, created, modified or deleted and the
+# attributes to send
+change = Tuple['Mo', str, Dict[str, str]]
+
+
+class Mo(object):
+    __slots__ = ('cls', 'attributes', 'children', 'parent')
+
+    def __init__(self, cls: str, attributes: Dict[str, str], parent: 'Mo' = None):
+        """A managed object of the synthetic fabric"""
+        self.cls = cls
+        self.attributes = attributes
+        self.children: List['Mo'] = []
+        self.parent = parent
+
+    @property
+    def dn(self) -> str:
+        return self.attributes['dn']
+
+    def subtree(self) -> Iterator['Mo']:
+        """All descendants in depth first order, without the object itself"""
+        for child in self.children:
+            yield child
+            yield from child.subtree()
+
+
+class Fabric(object):
+    def __init__(self, address: str, pods: int = 1, controllers: int = 3, spines: int = 2, leaves: int = 4,
+                 ports: int = 48, endpoints: int = 200, duplicate_ips: int = 5, faults: int = 50, seed: int = 0):
+        """Synthetic ACI fabric of the given size. Objects are indexed by dn and by class.
+           The first controller has address as its out-of-band management address."""
+        self.address = address
+        self.by_dn: Dict[str, Mo] = {}
+        self.by_class: Dict[str, List[Mo]] = {}
+        self.__random = random.Random(seed)
+        self.__churned = 0
+        self.__churned_ips = 0
+
+        self.root = self.add(None, 'topRoot', '', {})
+        self.add(self.root, 'fabricTopology', 'topology', {})
+        self.add(self.root, 'polUni', 'uni', {})
+
+        leaf_nodes = []
+        for i in range(controllers):
+            self.__add_node(1, 'controller', CONTROLLER_MODEL, i + 1)
+        for i in range(spines):
+            self.__add_node(1 + i % pods, 'spine', SPINE_MODEL, 201 + i, ports, endpoints)
+        for i in range(leaves):
+            model = LEAF_MODELS[i % len(LEAF_MODELS)]
+            leaf_nodes.append(self.__add_node(1 + i % pods, 'leaf', model, 101 + i, ports))
+
+        self.__add_endpoints(leaf_nodes, endpoints, duplicate_ips)
+        self.__add_faults(leaf_nodes, ports, faults)
+
+    def add(self, parent: Mo, cls: str, rn: str, attributes: Dict[str, str]) -> Mo:
+        dn = rn if parent is None or parent.dn == '' else parent.dn + '/' + rn
+        mo = Mo(cls, dict(attributes, dn=dn), parent)
+        if parent is not None:
+            parent.children.append(mo)
+        self.by_dn[dn] = mo
+        self.by_class.setdefault(cls, []).append(mo)
+        return mo
+
+    def __pod(self, pod_id: int) -> Mo:
+        dn = 'topology/pod-%s' % pod_id
+        if dn not in self.by_dn:
+            self.add(self.by_dn['topology'], 'fabricPod', 'pod-%s' % pod_id, {'id': str(pod_id)})
+        return self.by_dn[dn]
+
+    def __add_node(self, pod_id: int, role: str, model: str, node_id: int, ports: int = 0,
+                   coop_records: int = 0) -> Mo:
+        """Adds the fabricNode and the node's system tree"""
+        pod = self.__pod(pod_id)
+        name = '%s-%s' % (role, node_id)
+        node = self.add(pod, 'fabricNode', 'node-%s' % node_id, {
+            'id': str(node_id), 'role': role, 'model': model, 'name': name,
+            'adminSt': 'on', 'fabricSt': 'active' if role != 'controller' else 'unknown'})
+        oob = self.address if role == 'controller' and node_id == 1 else '10.0.%s.%s' % (pod_id, node_id)
+        system = self.add(node, 'topSystem', 'sys', {'id': str(node_id), 'podId': str(pod_id), 'name': name,
+                                                     'role': role, 'oobMgmtAddr': oob})
+
+        self.__add_processes(system, role)
+        self.add(self.add(self.add(self.add(system, 'eqptCh', 'ch', {}), 'eqptSupCSlot', 'supslot-1', {}),
+                          'eqptSupC', 'sup', {}),
+                 'eqptFlash', 'flash', {'type': 'flash', 'vendor': 'Micron',
+                                        'model': 'Micron_M500IT_MTFDDAT064MBD' if node_id % 3 else 'Micron_M600',
+                                        'acc': 'read-write' if node_id % 7 else 'read-only'})
+        for port in range(1, ports + 1):
+            admin_state = 'up' if port % 8 else 'down'
+            interface = self.add(system, 'l1PhysIf', 'phys-[eth1/%s]' % port, {'id': 'eth1/%s' % port,
+                                                                               'adminSt': admin_state})
+            self.add(interface, 'ethpmPhysIf', 'phys', {'operSt': 'up' if port % 3 else 'down',
+                                                        'resetCtr': str(self.__random.randint(0, 3))})
+        if role == 'leaf':
+            self.__add_capacity(system)
+        if role == 'spine':
+            self.__add_coop(system, coop_records)
+        return node
+
+    def __add_processes(self, system: Mo, role: str):
+        if role == 'controller':
+            self.add(system, 'procEntity', 'proc', {'cpuPct': str(self.__random.randint(5, 60)),
+                                                    'maxMemAlloc': '131072000', 'memFree': '65536000'})
+            return
+        processes = self.add(system, 'procEntity', 'proc', {'cpuPct': str(self.__random.randint(5, 60)),
+                                                            'maxMemAlloc': '32768000', 'memFree': '16384000'})
+        names = ['nfm', 'mcecm'] if role == 'leaf' else ['nfm']
+        for pid, name in enumerate(names, 1000):
+            proc = self.add(processes, 'procProc', 'proc-%s' % pid, {'id': str(pid), 'name': name,
+                                                                     'operState': 'up'})
+            used = self.__random.randint(100000, 400000)
+            memory = {'usedMin': str(used - 1000), 'usedMax': str(used + 1000), 'usedAvg': str(used)}
+            self.add(proc, 'procProcMem5min', 'CDprocProcMem5min', memory)
+            self.add(proc, 'procProcMemHist5min', 'HDprocProcMem5min-0', dict(memory, index='0'))
+
+    def __add_capacity(self, system: Mo):
+        capacity = self.add(system, 'eqptcapacityEntity', 'eqptcapacity', {})
+        local = str(self.__random.randint(100, 5000))
+        remote = str(self.__random.randint(100, 5000))
+        stats = {
+            'eqptcapacityL3Usage5min': {'v4LocalEpLast': local, 'localEpCapMax': '24576'},
+            'eqptcapacityL3RemoteUsage5min': {'v4RemoteEpLast': remote},
+            'eqptcapacityL3RemoteUsageCap5min': {'v4RemoteEpCapMax': '24576'},
+            'eqptcapacityL3TotalUsage5min': {'v4TotalEpLast': str(int(local) + int(remote))},
+            'eqptcapacityL3TotalUsageCap5min': {'v4TotalEpCapMax': '65536'},
+            'eqptcapacityL2Usage5min': {'localEpLast': local, 'localEpCapMax': '65536'},
+            'eqptcapacityL2RemoteUsage5min': {'remoteEpLast': remote},
+            'eqptcapacityL2TotalUsage5min': {'totalEpLast': str(int(local) + int(remote)), 'totalEpCapMax': '65536'},
+        }
+        for cls, attributes in stats.items():
+            self.add(capacity, cls, 'CD' + cls, attributes)
+
+    def __add_coop(self, system: Mo, records: int):
+        domain = self.add(self.add(self.add(system, 'coopEntity', 'coop', {}), 'coopInst', 'inst', {}),
+                          'coopDom', 'dom-overlay-1', {'name': 'overlay-1'})
+        table = self.add(domain, 'coopEpDb', 'db-ep', {})
+        for i in range(records):
+            mac = self.__mac(i)
+            self.add(table, 'coopEpRec', 'mac-%s,vnid-%s' % (mac, 15000000 + i % 100), {'mac': mac})
+
+    def __add_endpoints(self, leaves: List[Mo], endpoints: int, duplicate_ips: int):
+        """Endpoints are spread over one tenant with an EPG per 100 endpoints"""
+        tenant = self.add(self.by_dn['uni'], 'fvTenant', 'tn-benchmark', {'name': 'benchmark'})
+        app = self.add(tenant, 'fvAp', 'ap-app', {'name': 'app'})
+        epg = None
+        for i in range(endpoints):
+            if i % 100 == 0:
+                epg = self.add(app, 'fvAEPg', 'epg-epg%s' % (i // 100), {'name': 'epg%s' % (i // 100)})
+            mac = self.__mac(i)
+            endpoint = self.add(epg, 'fvCEp', 'cep-' + mac, {'mac': mac, 'encap': 'vlan-%s' % (100 + i // 100)})
+            address = '10.%s.%s.%s' % (i // 65536 % 256, i // 256 % 256, i % 256)
+            message = ''
+            if i < duplicate_ips:
+                message = 'IP is also used by endpoint %s' % self.__mac(i + endpoints)
+            ip = self.add(endpoint, 'fvIp', 'ip-[%s]' % address, {'addr': address, 'debugMACMessage': message})
+            if leaves:
+                leaf = leaves[i % len(leaves)].attributes['id']
+                self.add(ip, 'fvReportingNode', 'node-%s' % leaf, {'id': leaf})
+
+    def __add_faults(self, leaves: List[Mo], ports: int, faults: int):
+        """Faults are raised on the ports of the leaves, at most one per fault code and port"""
+        slots = [(leaf, port) for port in range(1, ports + 1) for leaf in leaves]
+        if not slots:
+            return
+        faults = min(faults, len(slots) * len(FAULT_CODES))
+        for i in range(faults):
+            leaf, port = slots[i // len(FAULT_CODES) % len(slots)]
+            code = FAULT_CODES[i % len(FAULT_CODES)]
+            interface = self.by_dn['%s/sys/phys-[eth1/%s]' % (leaf.dn, port)]
+            self.add(interface, 'faultInst', 'fault-' + code, {
+                'code': code, 'lc': FAULT_LIFECYCLES[i % len(FAULT_LIFECYCLES)], 'severity': 'major',
+                'descr': 'Synthetic fault %s on eth1/%s' % (code, port), 'modTs': MOD_TS, 'created': MOD_TS})
+
+    def remove(self, mo: Mo):
+        """Removes the object with its subtree"""
+        for removed in [mo] + list(mo.subtree()):
+            del self.by_dn[removed.dn]
+            self.by_class[removed.cls].remove(removed)
+        if mo.parent is not None:
+            mo.parent.children.remove(mo)
+
+    def churn_faults(self, count: int) -> List[change]:
+        """Moves the next count faults to the following lifecycle and stamps them with the current time as
+           modTs. Returns the changes."""
+        faults = self.by_class.get('faultInst', [])
+        if not faults:
+            return []
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')
+        changes = {}
+        for _ in range(count):
+            fault = faults[self.__churned % len(faults)]
+            lifecycle = FAULT_LIFECYCLES.index(fault.attributes['lc'])
+            fault.attributes['lc'] = FAULT_LIFECYCLES[(lifecycle + 1) % len(FAULT_LIFECYCLES)]
+            fault.attributes['modTs'] = now
+            changes[fault.dn] = (fault, 'modified', {'lc': fault.attributes['lc'], 'modTs': now})
+            self.__churned += 1
+        return list(changes.values())
+
+    def churn_ips(self, count: int) -> List[change]:
+        """Takes turns in creating an endpoint with a duplicate IP, resolving the first duplicate IP and
+           deleting the last duplicate IP, count times. Returns the changes."""
+        changes = []
+        for _ in range(count):
+            step = self.__churned_ips % 3
+            self.__churned_ips += 1
+            duplicates = [ip for ip in self.by_class.get('fvIp', []) if ip.attributes['debugMACMessage']]
+            if step == 0:
+                changes.extend(self.__create_duplicate_ip())
+            elif step == 1 and duplicates:
+                duplicates[0].attributes['debugMACMessage'] = ''
+                changes.append((duplicates[0], 'modified', {'debugMACMessage': ''}))
+            elif step == 2 and duplicates:
+                self.remove(duplicates[-1])
+                changes.append((duplicates[-1], 'deleted', {}))
+        return changes
+
+    def __create_duplicate_ip(self) -> List[change]:
+        epg = self.by_class.get('fvAEPg', [None])[0]
+        if epg is None:
+            return []
+        i = CHURNED_ENDPOINTS + self.__churned_ips
+        mac = self.__mac(i)
+        endpoint = self.add(epg, 'fvCEp', 'cep-' + mac, {'mac': mac, 'encap': 'vlan-100'})
+        address = '10.%s.%s.%s' % (i // 65536 % 256, i // 256 % 256, i % 256)
+        ip = self.add(endpoint, 'fvIp', 'ip-[%s]' % address, {
+            'addr': address, 'debugMACMessage': 'IP is also used by endpoint %s' % self.__mac(i + 1)})
+        changes = [(ip, 'created', ip.attributes)]
+        leaves = self.by_class.get('fvReportingNode', [])
+        if leaves:
+            node = self.add(ip, 'fvReportingNode', leaves[0].dn.rpartition('/')[2], {
+                'id': leaves[0].attributes['id']})
+            changes.append((node, 'created', node.attributes))
+        return changes
+
+    def __mac(self, i: int) -> str:
+        return '00:50:56:%02X:%02X:%02X' % (i // 65536 % 256, i // 256 % 256, i % 256)
@@ -0,0 +1,457 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import secrets
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import click
+
+from aiohttp import web, WSMsgType
+from collections import Counter
+from benchmark.Fabric import Fabric, Mo, change
+from modules.Instrumentation import query_class
+
+from typing import Callable, Dict, List, Tuple
+
+LOG = logging.getLogger('apic_exporter.mock')
+TOKEN_LIFETIME = 600
+SUBSCRIPTION_LIFETIME = 90
+STATS_CLASS = re.compile(r'(5min|15min|1h|1d|1w|1mo|1qtr|1year)(-\d+)?$')
+CLASS_QUERY = re.compile(r'^/api/(?:node/)?class/(?:(.+)/)?(\w+)\.json$')
+MO_QUERY = re.compile(r'^/api/(?:node/)?mo/(.*)\.json$')
+FILTER_TOKEN = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([\w.:-]+)|(\S))')
+
+
+class QueryError(Exception):
+    pass
+
+
+def compare(a: str, b: str) -> int:
+    """Compares numbers numerically and everything else as strings"""
+    try:
+        a, b = float(a), float(b)
+    except ValueError:
+        pass
+    return (a > b) - (a < b)
+
+
+COMPARATORS = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'lt': lambda a, b: compare(a, b) < 0,
+    'gt': lambda a, b: compare(a, b) > 0,
+    'le': lambda a, b: compare(a, b) <= 0,
+    'ge': lambda a, b: compare(a, b) >= 0,
+    'bw': lambda a, low, high: compare(a, low) >= 0 and compare(a, high) <= 0,
+    'wcard': lambda a, b: re.search(b, a) is not None,
+}
+
+
+class FilterParser(object):
+    def __init__(self, expression: str):
+        """Compiles a query-target-filter like and(eq(fvIp.addr,"10.0.0.1"),ne(fvIp.debugMACMessage,""))
+           into a predicate over managed objects"""
+        self.__expression = expression
+        self.__tokens = FILTER_TOKEN.findall(expression)
+        self.__position = 0
+
+    def parse(self) -> Callable[[Mo], bool]:
+        predicate = self.__parse_expression()
+        if self.__position != len(self.__tokens):
+            raise QueryError("Trailing characters in filter " + self.__expression)
+        return predicate
+
+    def __peek(self, offset: int = 0) -> Tuple[str, str, str]:
+        if self.__position + offset < len(self.__tokens):
+            return self.__tokens[self.__position + offset]
+        return None, None, None
+
+    def __next(self) -> Tuple[str, str, str]:
+        token = self.__peek()
+        if token[2] is None:
+            raise QueryError("Unexpected end of filter " + self.__expression)
+        self.__position += 1
+        return token
+
+    def __expect(self, char: str):
+        if self.__next()[2] != char:
+            raise QueryError("Expected '%s' in filter %s" % (char, self.__expression))
+
+    def __parse_expression(self) -> Callable[[Mo], bool]:
+        name = self.__next()[1]
+        self.__expect('(')
+        arguments = [self.__parse_argument()]
+        while self.__peek()[2] == ',':
+            self.__next()
+            arguments.append(self.__parse_argument())
+        self.__expect(')')
+        return self.__build(name, arguments)
+
+    def __parse_argument(self) -> Tuple[str, object]:
+        """Returns the kind of the argument, which is an expression, a property or a quoted value"""
+        quoted, word, _ = self.__peek()
+        if word and self.__peek(1)[2] == '(':
+            return 'expression', self.__parse_expression()
+        self.__next()
+        if word:
+            return 'property', word
+        return 'value', quoted
+
+    def __build(self, name: str, arguments: List[Tuple[str, object]]) -> Callable[[Mo], bool]:
+        if name in ('and', 'or', 'not'):
+            predicates = [argument for kind, argument in arguments if kind == 'expression']
+            if len(predicates) != len(arguments):
+                raise QueryError("%s expects expressions in filter %s" % (name, self.__expression))
+            if name == 'and':
+                return lambda mo: all(predicate(mo) for predicate in predicates)
+            if name == 'or':
+                return lambda mo: any(predicate(mo) for predicate in predicates)
+            return lambda mo: not predicates[0](mo)
+
+        comparator = COMPARATORS.get(name)
+        if comparator is None:
+            raise QueryError("Unsupported filter %s" % name)
+        if len(arguments) < 2 or arguments[0][0] != 'property':
+            raise QueryError("%s expects a property and a value in filter %s" % (name, self.__expression))
+        cls, _, attribute = arguments[0][1].partition('.')
+        values = [value for _, value in arguments[1:]]
+
+        def predicate(mo: Mo) -> bool:
+            if mo.cls != cls or attribute not in mo.attributes:
+                return False
+            return comparator(mo.attributes[attribute], *values)
+        return predicate
+
+
+class QueryEngine(object):
+    def __init__(self, fabric: Fabric):
+        """Evaluates APIC class and mo queries against the synthetic fabric"""
+        self.__fabric = fabric
+
+    def query(self, path: str, params: Dict[str, str]) -> Dict:
+        """Returns the response of the query. Raises QueryError for invalid queries"""
+        objects = self.__select(path, params)
+        if 'query-target-filter' in params:
+            predicate = FilterParser(params['query-target-filter']).parse()
+            objects = [mo for mo in objects if predicate(mo)]
+
+        include = set(params.get('rsp-subtree-include', '').split(','))
+        if 'count' in include:
+            count = {'moCount': {'attributes': {'count': str(len(objects)), 'dn': ''}}}
+            return {'totalCount': '1', 'imdata': [count]}
+
+        for order in reversed(params.get('order-by', '').split(',') if 'order-by' in params else []):
+            prop, _, direction = order.partition('|')
+            attribute = prop.partition('.')[2]
+            objects = sorted(objects, key=lambda mo: mo.attributes.get(attribute, ''),
+                             reverse=direction == 'desc')
+
+        total = len(objects)
+        if 'page-size' in params:
+            try:
+                page_size = int(params['page-size'])
+                page = int(params.get('page', 0))
+            except ValueError:
+                raise QueryError("Invalid page or page-size")
+            objects = objects[page * page_size:(page + 1) * page_size]
+
+        subtree = params.get('rsp-subtree', 'no')
+        classes = set(filter(None, params.get('rsp-subtree-class', '').split(',')))
+        stats = 'stats' in include
+        return {'totalCount': str(total),
+                'imdata': [self.__render(mo, subtree, classes, stats) for mo in objects]}
+
+    def __select(self, path: str, params: Dict[str, str]) -> List[Mo]:
+        match = CLASS_QUERY.match(path)
+        if match is not None:
+            scope, cls = match.groups()
+            objects = self.__fabric.by_class.get(cls, [])
+            if scope is not None:
+                objects = [mo for mo in objects if mo.dn.startswith(scope + '/')]
+        else:
+            match = MO_QUERY.match(path)
+            if match is None:
+                raise QueryError("Unknown query " + path)
+            mo = self.__fabric.by_dn.get(match.group(1))
+            objects = [] if mo is None else [mo]
+
+        target = params.get('query-target', 'self')
+        if target == 'self':
+            return objects
+        if target not in ('children', 'subtree'):
+            raise QueryError("Invalid query-target " + target)
+        targets = []
+        for mo in objects:
+            if target == 'children':
+                targets.extend(mo.children)
+            else:
+                targets.append(mo)
+                targets.extend(mo.subtree())
+        classes = set(filter(None, params.get('target-subtree-class', '').split(',')))
+        if classes:
+            targets = [mo for mo in targets if mo.cls in classes]
+        return targets
+
+    def __render(self, mo: Mo, subtree: str, classes: set, stats: bool) -> Dict:
+        """Renders the object with the children requested by rsp-subtree, rsp-subtree-class and
+           rsp-subtree-include=stats. A full subtree limited to classes keeps the path to the matching objects"""
+        if subtree == 'full':
+            children = [child for child in (self.__render_full(child, classes) for child in mo.children)
+                        if child is not None]
+        elif subtree == 'children':
+            children = [{child.cls: {'attributes': child.attributes}} for child in mo.children
+                        if not classes or child.cls in classes]
+        elif stats:
+            children = [{child.cls: {'attributes': child.attributes}} for child in mo.children
+                        if STATS_CLASS.search(child.cls) and (not classes or child.cls in classes)]
+        else:
+            children = []
+        rendered = {'attributes': mo.attributes}
+        if children:
+            rendered['children'] = children
+        return {mo.cls: rendered}
+
+    def __render_full(self, mo: Mo, classes: set) -> Dict:
+        children = [child for child in (self.__render_full(child, classes) for child in mo.children)
+                    if child is not None]
+        if classes and not children and mo.cls not in classes:
+            return None
+        rendered = {'attributes': mo.attributes}
+        if children:
+            rendered['children'] = children
+        return {mo.cls: rendered}
+
+
+class MockApic(object):
+    def __init__(self, fabric: Fabric, user: str = None, password: str = None,
+                 token_lifetime: int = TOKEN_LIFETIME, latency: float = 0):
+        """HTTP stand-in for an APIC serving the synthetic fabric. Logins are checked against user and
+           password if given, tokens expire after token_lifetime seconds and every response is delayed
+           by latency seconds. Counts requests, objects and bytes by query class."""
+        self.__fabric = fabric
+        self.__engine = QueryEngine(fabric)
+        self.__user = user
+        self.__password = password
+        self.__token_lifetime = token_lifetime
+        self.__latency = latency
+        self.__tokens: Dict[str, float] = {}
+        # subscriptions by id with their matcher and expiry, events are pushed to every open websocket
+        self.__subscriptions: Dict[str, Tuple[Callable[[Mo], bool], float]] = {}
+        self.__sockets: List[web.WebSocketResponse] = []
+        self.stats = Counter()
+        self.queries = Counter()
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/aaaLogin.json', self.login)
+        app.router.add_get('/api/aaaRefresh.json', self.refresh)
+        app.router.add_get('/mock/stats', self.get_stats)
+        app.router.add_post('/mock/reset', self.reset_stats)
+        app.router.add_post('/mock/churn', self.churn)
+        app.router.add_get('/socket{token}', self.socket)
+        app.router.add_get('/api/subscriptionRefresh.json', self.refresh_subscription)
+        app.router.add_get('/api/{query:.*}', self.query)
+        return app
+
+    def __token_response(self) -> web.Response:
+        token = secrets.token_urlsafe(32)
+        self.__tokens[token] = time.monotonic() + self.__token_lifetime
+        response = web.json_response({'totalCount': '1', 'imdata': [{'aaaLogin': {'attributes': {
+            'token': token, 'refreshTimeoutSeconds': str(self.__token_lifetime),
+            'maximumLifetimeSeconds': '86400', 'userName': self.__user or 'admin'}}}]})
+        response.set_cookie('APIC-cookie', token)
+        return response
+
+    def __authorized(self, request: web.Request) -> bool:
+        expiry = self.__tokens.get(request.cookies.get('APIC-cookie'))
+        return expiry is not None and expiry > time.monotonic()
+
+    def __error(self, status: int, text: str) -> web.Response:
+        return web.json_response({'totalCount': '1', 'imdata': [{'error': {'attributes': {
+            'code': str(status), 'text': text}}}]}, status=status)
+
+    async def login(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.__latency)
+        self.stats['logins'] += 1
+        try:
+            attributes = (await request.json())['aaaUser']['attributes']
+        except (ValueError, KeyError):
+            return self.__error(400, 'Invalid login request')
+        if (self.__user is not None and attributes.get('name') != self.__user
+                or self.__password is not None and attributes.get('pwd') != self.__password):
+            return self.__error(401, 'Username or password is incorrect - FAILED local authentication')
+        return self.__token_response()
+
+    async def refresh(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.__latency)
+        self.stats['refreshes'] += 1
+        if not self.__authorized(request):
+            return self.__error(403, 'Token was invalid (Error: Token timeout)')
+        return self.__token_response()
+
+    async def query(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.__latency)
+        self.stats['requests'] += 1
+        self.queries[query_class(request.path_qs)] += 1
+        if not self.__authorized(request):
+            return self.__error(403, 'Token was invalid (Error: Token timeout)')
+        try:
+            response = self.__engine.query(request.path, dict(request.query))
+        except QueryError as e:
+            return self.__error(400, str(e))
+        if request.query.get('subscription') == 'yes':
+            response['subscriptionId'] = self.__subscribe(request.path, dict(request.query))
+        body = json.dumps(response).encode()
+        self.stats['objects'] += len(response['imdata'])
+        self.stats['bytes'] += len(body)
+        response = web.Response(body=body, content_type='application/json')
+        # gzip if the client accepts it, like the web server of an APIC
+        response.enable_compression()
+        return response
+
+    def __subscribe(self, path: str, params: Dict[str, str]) -> str:
+        """Registers a subscription to the objects of the query. Events are sent for every change of an
+           object of the queried class or dn, and of its children if the query includes the subtree,
+           regardless of the query-target-filter."""
+        subtree = params.get('rsp-subtree', 'no') != 'no'
+        classes = set(filter(None, params.get('rsp-subtree-class', '').split(',')))
+        match = CLASS_QUERY.match(path)
+        if match is not None:
+            scope, cls = match.groups()
+
+            def selected(mo: Mo) -> bool:
+                return mo.cls == cls and (scope is None or mo.dn.startswith(scope + '/'))
+        else:
+            dn = MO_QUERY.match(path).group(1)
+
+            def selected(mo: Mo) -> bool:
+                return mo.dn == dn
+
+        def matcher(mo: Mo) -> bool:
+            if selected(mo):
+                return True
+            return (subtree and mo.parent is not None and selected(mo.parent)
+                    and (not classes or mo.cls in classes))
+
+        subscription_id = str(int(time.time() * 1000)) + secrets.token_hex(4)
+        self.__subscriptions[subscription_id] = (matcher, time.monotonic() + SUBSCRIPTION_LIFETIME)
+        self.stats['subscriptions'] += 1
+        return subscription_id
+
+    async def refresh_subscription(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.__latency)
+        self.stats['subscription_refreshes'] += 1
+        if not self.__authorized(request):
+            return self.__error(403, 'Token was invalid (Error: Token timeout)')
+        subscription = self.__subscriptions.get(request.query.get('id'))
+        if subscription is None or subscription[1] < time.monotonic():
+            return self.__error(400, 'Subscription refresh failed, subscription not found')
+        self.__subscriptions[request.query['id']] = (subscription[0], time.monotonic() + SUBSCRIPTION_LIFETIME)
+        return web.json_response({'totalCount': '0', 'imdata': []})
+
+    async def socket(self, request: web.Request) -> web.WebSocketResponse:
+        """The event websocket, opened with the token in the path like /socket<token>"""
+        expiry = self.__tokens.get(request.match_info['token'])
+        if expiry is None or expiry < time.monotonic():
+            return self.__error(403, 'Token was invalid (Error: Token timeout)')
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.__sockets.append(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.__sockets.remove(ws)
+        return ws
+
+    async def publish(self, changes: List[change]):
+        """Pushes an event per change to the open websockets, listing the subscriptions it matches"""
+        now = time.monotonic()
+        for mo, status, attributes in changes:
+            subscription_ids = [subscription_id for subscription_id, (matcher, expiry)
+                                in self.__subscriptions.items() if expiry >= now and matcher(mo)]
+            if not subscription_ids:
+                continue
+            event = json.dumps({'subscriptionId': subscription_ids, 'imdata': [{mo.cls: {'attributes': dict(
+                attributes, dn=mo.dn, status=status)}}]})
+            for ws in list(self.__sockets):
+                await ws.send_str(event)
+                self.stats['events'] += 1
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats, queries=dict(self.queries)))
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.stats.clear()
+        self.queries.clear()
+        return web.json_response({})
+
+    async def churn(self, request: web.Request) -> web.Response:
+        """Changes the lifecycle and modTs of the number of faults given by the faults parameter and creates,
+           resolves or deletes as many duplicate IPs as the ips parameter gives. The changes are pushed to
+           the subscriptions."""
+        try:
+            faults = int(request.query.get('faults', '0' if 'ips' in request.query else '1'))
+            ips = int(request.query.get('ips', '0'))
+        except ValueError:
+            return self.__error(400, 'Invalid number of faults or ips')
+        fault_changes = self.__fabric.churn_faults(faults)
+        ip_changes = self.__fabric.churn_ips(ips)
+        await self.publish(fault_changes + ip_changes)
+        return web.json_response({'faults': len(fault_changes), 'ips': len(ip_changes)})
+
+
+def create_ssl_context(cert: str, key: str) -> ssl.SSLContext:
+    """Uses the given certificate or creates a self-signed one with openssl"""
+    if cert is None:
+        directory = tempfile.mkdtemp(prefix='mock-apic-')
+        cert = os.path.join(directory, 'cert.pem')
+        key = os.path.join(directory, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=mock-apic', '-keyout', key, '-out', cert],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+@click.command()
+@click.option("--host", default='127.0.0.1', help="address to listen on")
+@click.option("-p", "--port", default=8443, help="port to listen on")
+@click.option("--cert", help="TLS certificate, a self-signed one is created if omitted")
+@click.option("--key", help="TLS private key of the certificate")
+@click.option("--user", help="accepted login user, any user is accepted if omitted")
+@click.option("--password", help="accepted login password, any password is accepted if omitted")
+@click.option("--token-lifetime", default=TOKEN_LIFETIME, help="seconds until a token expires")
+@click.option("--latency", default=0.0, help="seconds every response is delayed")
+@click.option("--pods", default=1, help="number of pods")
+@click.option("--controllers", default=3, help="number of APIC controllers")
+@click.option("--spines", default=2, help="number of spine switches")
+@click.option("--leaves", default=4, help="number of leaf switches")
+@click.option("--ports", default=48, help="number of physical ports per switch")
+@click.option("--endpoints", default=200, help="number of endpoints with one IP each")
+@click.option("--duplicate-ips", default=5, help="number of endpoint IPs flagged as duplicate")
+@click.option("--faults", default=50, help="number of faults raised on leaf ports")
+@click.help_option()
+def main(host, port, cert, key, user, password, token_lifetime, latency,
+         pods, controllers, spines, leaves, ports, endpoints, duplicate_ips, faults):
+    """Serves a synthetic ACI fabric through the APIC REST API"""
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] [%(levelname)s] %(message)s', level=logging.INFO)
+
+    start = time.monotonic()
+    fabric = Fabric('%s:%s' % (host, port), pods, controllers, spines, leaves, ports, endpoints, duplicate_ips, faults)
+    LOG.info("Generated %s objects in %.1f sec", len(fabric.by_dn), time.monotonic() - start)
+
+    mock = MockApic(fabric, user, password, token_lifetime, latency)
+    web.run_app(mock.application(), host=host, port=port, ssl_context=create_ssl_context(cert, key),
+                access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import click
+import requests
+import yaml
+
+from benchmark.Fabric import Fabric
+from benchmark.MockApic import QueryEngine
+from exporter import get_default_collectors, initialize_collector_by_name
+from modules import JsonDecoder
+from modules.Subscription import SUBSCRIPTION_REFRESH
+
+from typing import Dict, List, Set, Tuple
+
+LOG = logging.getLogger('apic_exporter.benchmark')
+MOCK_STARTUP_TIMEOUT = 120
+SUBSCRIBED_COLLECTORS = ['ApicIPsCollector', 'ApicMCPCollector']
+# stores added after the websocket was opened are subscribed with the next refresh
+SUBSCRIPTION_TIMEOUT = 2 * SUBSCRIPTION_REFRESH
+# classes the subscribed collectors poll until their subscriptions are in sync
+SUBSCRIBED_CLASSES = ['fvIp', 'faultInst']
+# representative large responses rendered from the synthetic fabric by the decode benchmark
+DECODE_QUERIES = {
+    'fvIp': ('/api/node/class/fvIp.json', {'rsp-subtree': 'full', 'rsp-subtree-class': 'fvReportingNode'}),
+    'ethpmPhysIf': ('/api/node/class/ethpmPhysIf.json', {}),
+    'faultInst': ('/api/node/class/faultInst.json', {}),
+    'topSystem': ('/api/node/class/topSystem.json', {'rsp-subtree': 'full'}),
+}
+
+
+def fabric_size(leaves: int, ports: int, endpoints_per_leaf: int, faults_per_leaf: int) -> Dict[str, int]:
+    """Fabric dimensions for the number of leaves, with a spine per eight leaves and one percent duplicate IPs"""
+    endpoints = leaves * endpoints_per_leaf
+    return {'spines': max(2, leaves // 8), 'leaves': leaves, 'ports': ports, 'endpoints': endpoints,
+            'duplicate-ips': endpoints // 100, 'faults': leaves * faults_per_leaf}
+
+
+def child_environment() -> Dict[str, str]:
+    """The mock APIC uses a self-signed certificate. A CA bundle from the environment would take precedence
+       over the disabled verification of the exporter sessions"""
+    env = dict(os.environ)
+    env.pop('REQUESTS_CA_BUNDLE', None)
+    env.pop('CURL_CA_BUNDLE', None)
+    return env
+
+
+def wait_for_port(port: int, process: subprocess.Popen):
+    deadline = time.monotonic() + MOCK_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise click.ClickException("Mock APIC exited with %s" % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException("Mock APIC did not start within %s sec" % MOCK_STARTUP_TIMEOUT)
+
+
+def mock_session() -> requests.Session:
+    session = requests.Session()
+    session.verify = False
+    session.trust_env = False
+    return session
+
+
+def mock_stats(host: str, reset: bool = False) -> Dict:
+    session = mock_session()
+    stats = session.get('https://' + host + '/mock/stats').json()
+    if reset:
+        session.post('https://' + host + '/mock/reset')
+    return stats
+
+
+def collected_series(collectors: List) -> Set[Tuple]:
+    return {(sample.name, tuple(sorted(sample.labels.items())), sample.value)
+            for c in collectors for metric in c.collect() for sample in metric.samples}
+
+
+@click.group()
+def cli():
+    """Benchmarks the collectors against a local mock APIC"""
+    pass
+
+
+@cli.command()
+@click.option("--sizes", default='4,16,64', help="comma separated numbers of leaves of the benchmarked fabrics")
+@click.option("--ports", default=48, help="physical ports per switch")
+@click.option("--endpoints-per-leaf", default=100, help="endpoints per leaf")
+@click.option("--faults-per-leaf", default=20, help="faults per leaf")
+@click.option("--latency", default=0.0, help="seconds the mock APIC delays every response")
+@click.option("--collectors", help="comma separated collectors, all collectors if omitted")
+@click.option("-o", "--option", "options", multiple=True, metavar="<key=value>",
+              help="collector setting of the aci config section, e.g. process_query_mode=class")
+@click.option("--repeat", default=3, help="scrapes measured after the first scrape")
+@click.option("-p", "--port", default=9443, help="port of the mock APIC")
+@click.option("--output", help="write the results as json to this file")
+def run(sizes, ports, endpoints_per_leaf, faults_per_leaf, latency, collectors, options, repeat, port, output):
+    """Runs every collector in its own process against mock fabrics of growing size"""
+    names = collectors.split(',') if collectors else get_default_collectors()
+    results = []
+    for leaves in [int(size) for size in sizes.split(',')]:
+        size = fabric_size(leaves, ports, endpoints_per_leaf, faults_per_leaf)
+        command = [sys.executable, '-m', 'benchmark.MockApic', '--port', str(port), '--latency', str(latency)]
+        for key, value in size.items():
+            command += ['--' + key, str(value)]
+        mock = subprocess.Popen(command, stdout=subprocess.DEVNULL, env=child_environment())
+        try:
+            wait_for_port(port, mock)
+            for name in names:
+                result = run_collector_process(name, '127.0.0.1:%s' % port, options, repeat)
+                if result is not None:
+                    results.append(dict(result, **size))
+                    print_result(results[-1], len(results) == 1)
+        finally:
+            mock.terminate()
+            mock.wait()
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def run_collector_process(name: str, host: str, options: List[str], repeat: int) -> Dict:
+    command = [sys.executable, '-m', 'benchmark.benchmark', 'collector', name, '--host', host, '--repeat', str(repeat)]
+    for option in options:
+        command += ['-o', option]
+    process = subprocess.run(command, capture_output=True, text=True, env=child_environment())
+    if process.returncode != 0:
+        LOG.error("Benchmark of %s failed:\n%s", name, process.stderr)
+        return None
+    return json.loads(process.stdout)
+
+
+def print_result(result: Dict, header: bool):
+    if header:
+        print('%6s  %-28s %9s %9s %8s %8s %10s %9s %8s' % ('leaves', 'collector', 'cold [s]', 'warm [s]', 'queries',
+                                                           'objects', 'bytes', 'cpu [s]', 'rss [MB]'))
+    print('%6s  %-28s %9.3f %9.3f %8.1f %8.0f %10.0f %9.3f %8.1f' % (
+        result['leaves'], result['collector'], result['cold_seconds'], result['warm_seconds'],
+        result['queries'], result['objects'], result['bytes'], result['cpu_seconds'], result['rss_mb']))
+    sys.stdout.flush()
+
+
+@cli.command()
+@click.argument("name")
+@click.option("--host", required=True, help="address of the mock APIC")
+@click.option("-o", "--option", "options", multiple=True, metavar="<key=value>",
+              help="collector setting of the aci config section")
+@click.option("--repeat", default=3, help="scrapes measured after the first scrape")
+def collector(name, host, options, repeat):
+    """Measures a single collector and prints the result as json. The first scrape includes filling
+       the shared caches, the others are reported per scrape"""
+    config = {'apic_hosts': host, 'apic_user': 'admin', 'apic_password': 'admin'}
+    for option in options:
+        # values are parsed as in the config file, e.g. subscription_mode=false is a boolean
+        key, _, value = option.partition('=')
+        config[key] = yaml.safe_load(value)
+    c = initialize_collector_by_name(name, config)
+    if c is None:
+        raise click.ClickException("Unknown collector " + name)
+    mock_stats(host, reset=True)
+
+    start, cpu = time.perf_counter(), time.process_time()
+    metrics = list(c.collect())
+    cold_seconds = time.perf_counter() - start
+    cold_cpu = time.process_time() - cpu
+    cold = mock_stats(host, reset=True)
+
+    durations = []
+    cpu = time.process_time()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        metrics = list(c.collect())
+        durations.append(time.perf_counter() - start)
+    warm_cpu = time.process_time() - cpu
+    warm = mock_stats(host)
+
+    scrapes = max(repeat, 1)
+    print(json.dumps({
+        'collector': name,
+        'cold_seconds': cold_seconds,
+        'cold_cpu_seconds': cold_cpu,
+        'cold_queries': cold.get('requests', 0),
+        'warm_seconds': statistics.median(durations) if durations else cold_seconds,
+        'cpu_seconds': warm_cpu / scrapes if durations else cold_cpu,
+        'queries': warm.get('requests', 0) / scrapes if durations else cold.get('requests', 0),
+        'objects': warm.get('objects', 0) / scrapes if durations else cold.get('objects', 0),
+        'bytes': warm.get('bytes', 0) / scrapes if durations else cold.get('bytes', 0),
+        'queries_by_class': warm.get('queries', {}) if durations else cold.get('queries', {}),
+        'series': sum(len(metric.samples) for metric in metrics),
+        # peak resident set size of the collector process, ru_maxrss is in KiB on Linux
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+@cli.command()
+@click.option("--host", required=True, help="address of the mock APIC")
+@click.option("--rounds", default=3, help="rounds of changes checked")
+@click.option("--ips", default=3, help="duplicate IPs created, resolved or deleted per round")
+@click.option("--faults", default=0, help="faults moved to the next lifecycle per round")
+def subscription(host, rounds, ips, faults):
+    """Checks the collectors in subscription mode against polling while the mock APIC creates, modifies
+       and deletes objects. Passes once the subscribed collectors report the same series as the polling
+       ones after every round, without querying their classes."""
+    config = {'apic_hosts': host, 'apic_user': 'admin', 'apic_password': 'admin'}
+    polled = [initialize_collector_by_name(name, config) for name in SUBSCRIBED_COLLECTORS]
+    subscribed = [initialize_collector_by_name(name, dict(config, subscription_mode=True))
+                  for name in SUBSCRIBED_COLLECTORS]
+    session = mock_session()
+
+    def converged() -> bool:
+        deadline = time.monotonic() + SUBSCRIPTION_TIMEOUT
+        while time.monotonic() < deadline:
+            expected = collected_series(polled)
+            mock_stats(host, reset=True)
+            series = collected_series(subscribed)
+            queries = mock_stats(host).get('queries', {})
+            if series == expected and not any(queries.get(cls) for cls in SUBSCRIBED_CLASSES):
+                return True
+            time.sleep(0.5)
+        LOG.error("Missing series: %s", sorted(expected - series))
+        LOG.error("Unexpected series: %s", sorted(series - expected))
+        return False
+
+    if not converged():
+        raise click.ClickException("Subscriptions did not sync within %s sec" % SUBSCRIPTION_TIMEOUT)
+    print('synced %s series' % len(collected_series(subscribed)))
+    for i in range(rounds):
+        changed = session.post('https://%s/mock/churn?ips=%s&faults=%s' % (host, ips, faults)).json()
+        if not converged():
+            raise click.ClickException("Round %s: subscribed series differ from polled series" % (i + 1))
+        print('round %s: %s ip and %s fault changes applied, %s series match' % (
+            i + 1, changed['ips'], changed['faults'], len(collected_series(subscribed))))
+
+
+@cli.command()
+@click.argument("payloads", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option("--leaves", default=64, help="leaves of the synthetic fabric rendering the payloads if none are given")
+@click.option("--repeat", default=5, help="decodings measured per payload and backend")
+def decode(payloads, leaves, repeat):
+    """Compares the JSON backends on recorded APIC responses, e.g. saved with curl, or on large responses
+       rendered from a synthetic fabric"""
+    if payloads:
+        bodies = {}
+        for path in payloads:
+            with open(path, 'rb') as f:
+                bodies[os.path.basename(path)] = f.read()
+    else:
+        size = fabric_size(leaves, 48, 100, 20)
+        engine = QueryEngine(Fabric('127.0.0.1', spines=size['spines'], leaves=leaves, ports=size['ports'],
+                                    endpoints=size['endpoints'], duplicate_ips=size['duplicate-ips'],
+                                    faults=size['faults']))
+        bodies = {name: json.dumps(engine.query(path, params)).encode()
+                  for name, (path, params) in DECODE_QUERIES.items()}
+
+    print('%-24s %10s  %-8s %10s %10s %8s' % ('payload', 'size [MB]', 'backend', 'time [s]', 'MB/s', 'speedup'))
+    for name, body in bodies.items():
+        baseline = None
+        for backend in reversed(JsonDecoder.available_backends()):
+            loads = JsonDecoder.BACKENDS[backend]
+            durations = []
+            for _ in range(max(repeat, 1)):
+                start = time.perf_counter()
+                loads(body)
+                durations.append(time.perf_counter() - start)
+            seconds = statistics.median(durations)
+            baseline = baseline or seconds
+            megabytes = len(body) / 2 ** 20
+            print('%-24s %10.2f  %-8s %10.4f %10.1f %7.1fx' % (name, megabytes, backend, seconds,
+                                                               megabytes / seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+    cli()
@@ -16,7 +16,8 @@ class ApicCoopDbCollector(Collector):
                                 'APIC COOP DB entries')
 
     def get_query(self) -> str:
-        return '/api/node/class/fabricNode.json?query-target-filter=eq(fabricNode.role,"spine")'
+        # spines are taken from the topology cache
+        return None
 
     def get_metrics(self, host: str, data: Dict) -> List[GaugeMetricFamily]:
         """Collect the number of entries in the coop db for all spines"""
@@ -24,17 +25,20 @@ class ApicCoopDbCollector(Collector):
                                       'APIC COOP DB entries',
                                       labels=['apicHost', 'spineDn'])
 
-        for spine in data['imdata']:
-            spine_attributes = spine['fabricNode']['attributes']
+        spines = self.get_fabric_nodes(host, 'spine')
+        if spines is None:
+            return None
+
+        for spine in spines:
             query_coop_count = '/api/node/mo/' + \
-                               spine_attributes['dn'] + \
+                               spine.dn + \
                                '/sys/coop/inst/dom-overlay-1.json' + \
                                '?query-target=subtree&target-subtree-class=coopEpRec&rsp-subtree-include=count'
             fetched_data = self.query_host(host, query_coop_count)
             if fetched_data is None:
                 return None
             fetched_count = fetched_data['imdata'][0]['moCount']['attributes']['count']
-            g_coop_db.add_metric(labels=[host, spine_attributes['dn']],
+            g_coop_db.add_metric(labels=[host, spine.dn],
                                  value=fetched_count)
 
         return [g_coop_db]
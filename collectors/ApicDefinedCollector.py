@@ -0,0 +1,13 @@
+from DefinitionCollector import DefinitionCollector
+from modules.Definitions import load_definitions
+from typing import Dict
+
+
+class ApicDefinedCollector(DefinitionCollector):
+    def __init__(self, config: Dict):
+        """Collects the metric definitions of the yaml files listed in the definitions setting of the aci section.
+           Their queries are issued concurrently on every scrape."""
+        definitions = []
+        for path in config.get('definitions') or []:
+            definitions.extend(load_definitions(path))
+        super().__init__('apic_defined', config, definitions, config.get('definition_query_mode', 'class'))
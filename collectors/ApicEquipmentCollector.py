@@ -10,6 +10,7 @@ LOG = logging.getLogger('apic_exporter.exporter')
 
 
 class ApicEquipmentCollector(Collector):
+    stream_query = True
 
     def __init__(self, config: Dict):
         super().__init__('apic_equipment', config)
@@ -87,8 +87,6 @@ class ApicHealthCollector(BaseCollector.BaseCollector):
     def collect(self):
         LOG.debug('Collecting APIC health metrics ...')
 
-        self.reset_unavailable_hosts()
-
         self.__metric_counter = 0
 
         metrics: List[GaugeMetricFamily] = []
@@ -1,8 +1,11 @@
 import logging
 import re
 
-from prometheus_client.core import CounterMetricFamily, Summary
+from prometheus_client.core import Summary
+from modules.MetricBuilder import SeriesCache
+from modules.Transport import IncompleteResponse
 import BaseCollector
+from typing import Dict
 
 LOG = logging.getLogger('apic_exporter.exporter')
 REQUEST_TIME = Summary('apic_ips_processing_seconds',
@@ -10,58 +13,77 @@ REQUEST_TIME = Summary('apic_ips_processing_seconds',
 
 
 class ApicIPsCollector(BaseCollector.BaseCollector):
+    def __init__(self, config: Dict):
+        super().__init__(config)
+        self.__subscription_mode = bool(config.get('subscription_mode', False))
+        self.__duplicate_ips = SeriesCache('network_apic_duplicate_ip_counter',
+                                           'Counter for duplicate IPs',
+                                           ['apicHost', 'ip', 'mac', 'nodeId', 'tenant'], 'counter')
+
     def describe(self):
-        yield CounterMetricFamily('network_apic_duplicate_ip_counter',
-                                  'Counter for duplicate IPs')
+        yield self.__duplicate_ips.describe()
 
     @REQUEST_TIME.time()
     def collect(self):
         LOG.debug('Collecting APIC IP metrics ...')
 
-        c_dip = CounterMetricFamily(
-            'network_apic_duplicate_ip_counter',
-            'Counter for duplicate IPs',
-            labels=['apicHost', 'ip', 'mac', 'nodeId', 'tenant'])
+        c_dip = self.__duplicate_ips.builder()
 
         metric_counter = 0
         query = '/api/node/class/fvIp.json' + \
                 '?rsp-subtree=full' + \
-                '&rsp-subtree-class=fvReportingNode&query-target-filter=and(ne(fvIp.debugMACMessage,""))'
+                '&rsp-subtree-class=fvReportingNode&query-target-filter=and(ne(fvIp.debugMACMessage,""))' + \
+                '&order-by=fvIp.dn'
         for host in self.hosts:
-            fetched_data = self.query_host(host, query)
-            if fetched_data is None:
+            if self.__subscription_mode:
+                pages = self.query_host_subscribed(host, query)
+            else:
+                pages = self.query_host_paged(host, query)
+            if pages is None:
                 continue
 
-            if len(fetched_data['imdata']) == 0:
-                # Add Empty Counter to have the metric show up in Prometheus.
-                # Otherwise they only show when something is wrong and we dont know if it is actually working
-                c_dip.add_metric(labels=[host, '', '', '', ''], value=0)
-                metric_counter += 1
-                break  # Each host produces the same metrics.
+            duplicates = 0
+            try:
+                for page in pages:
+                    for ip in page['imdata']:
+                        # the subscription store may still hold IPs whose duplicate was resolved since
+                        if not ip['fvIp']['attributes'].get('debugMACMessage'):
+                            continue
+                        addr = ip['fvIp']['attributes']['addr']
+                        dn = ip['fvIp']['attributes']['dn']
+                        mac = re.search(r"([0-9A-F]{2}:){5}[0-9A-F]{2}", dn).group()
+                        tenant = re.match(r"uni\/tn-(.+)\/ap.+", dn)[1]
 
-            for ip in fetched_data['imdata']:
-                addr = ip['fvIp']['attributes']['addr']
-                dn = ip['fvIp']['attributes']['dn']
-                mac = re.search(r"([0-9A-F]{2}:){5}[0-9A-F]{2}", dn).group()
-                tenant = re.match(r"uni\/tn-(.+)\/ap.+", dn)[1]
+                        child_nodes = []
+                        if 'children' in ip['fvIp']:
+                            for child in ip['fvIp']['children']:
+                                node_id = child['fvReportingNode']['attributes']['id']
+                                child_nodes.append(str(node_id))
 
-                child_nodes = []
-                if 'children' in ip['fvIp']:
-                    for child in ip['fvIp']['children']:
-                        node_id = child['fvReportingNode']['attributes']['id']
-                        child_nodes.append(str(node_id))
+                        _nodeIds = 'None'
+                        if child_nodes:
+                            _nodeIds = '+'.join(child_nodes)
 
-                _nodeIds = 'None'
-                if child_nodes:
-                    _nodeIds = '+'.join(child_nodes)
+                        LOG.debug("host: %s, ip: %s, mac: %s, nodes: %s", host, addr, mac, _nodeIds)
+                        metric_counter += 1
+                        duplicates += 1
 
-                LOG.debug("host: %s, ip: %s, mac: %s, nodes: %s", host, addr, mac, _nodeIds)
-                metric_counter += 1
+                        c_dip.add((host, addr, mac, _nodeIds, tenant), 1)
+            except IncompleteResponse as e:
+                LOG.warning("Skipping apic host %s: %s", host, e)
+                c_dip = self.__duplicate_ips.builder()
+                metric_counter = 0
+                continue
 
-                c_dip.add_metric(labels=[host, addr, mac, _nodeIds, tenant],
-                                 value=1)
+            if duplicates == 0:
+                # Add Empty Counter to have the metric show up in Prometheus.
+                # Otherwise they only show when something is wrong and we dont know if it is actually working
+                c_dip.add((host, '', '', '', ''), 0)
+                metric_counter += 1
             break  # Each host produces the same metrics.
+        else:
+            self.mark_incomplete("no apic host returned the IP metrics")
 
-        yield c_dip
+        yield c_dip.build()
 
         LOG.info('Collected %s APIC IP metrics', metric_counter)
@@ -1,6 +1,9 @@
 import logging
 import BaseCollector
-from prometheus_client.core import GaugeMetricFamily, Summary
+from modules.MetricBuilder import SeriesCache
+from modules.Transport import IncompleteResponse
+from prometheus_client.core import Summary
+from typing import Dict
 
 LOG = logging.getLogger('apic_exporter.exporter')
 REQUEST_TIME = Summary('apic_interfaces_processing_seconds',
@@ -8,40 +11,49 @@ REQUEST_TIME = Summary('apic_interfaces_processing_seconds',
 
 
 class ApicInterfacesCollector(BaseCollector.BaseCollector):
-    def describe(self):
+    def __init__(self, config: Dict):
+        super().__init__(config)
+        self.__reset_counter = SeriesCache('network_apic_physcial_interface_reset_counter',
+                                           'APIC physical interface reset counter',
+                                           ['apicHost', 'interfaceID'])
 
-        yield GaugeMetricFamily(
-            'network_apic_physcial_interface_reset_counter',
-            'APIC physical interface reset counter')
+    def describe(self):
+        yield self.__reset_counter.describe()
 
     @REQUEST_TIME.time()
     def collect(self):
         LOG.debug('Collecting APIC interface metrics ...')
 
-        g = GaugeMetricFamily('network_apic_physcial_interface_reset_counter',
-                              'APIC physical interface reset counter',
-                              labels=['apicHost', 'interfaceID'])
+        g = self.__reset_counter.builder()
 
         metric_counter = 0
         # query only reset counters > 0
-        query = '/api/node/class/ethpmPhysIf.json?query-target-filter=gt(ethpmPhysIf.resetCtr,"0")'
+        query = '/api/node/class/ethpmPhysIf.json?query-target-filter=gt(ethpmPhysIf.resetCtr,"0")' + \
+                '&order-by=ethpmPhysIf.dn'
         for host in self.hosts:
-            fetched_data = self.query_host(host, query)
-            if fetched_data is None:
+            pages = self.query_host_paged(host, query)
+            if pages is None:
                 LOG.warning(
                     "Skipping apic host %s, %s did not return anything", host,
                     query)
                 continue
 
             # physical interface reset counter
-            for item in fetched_data['imdata']:
-
-                g.add_metric(
-                    labels=[host, item['ethpmPhysIf']['attributes']['dn']],
-                    value=item['ethpmPhysIf']['attributes']['resetCtr'])
-                metric_counter += 1
+            try:
+                for page in pages:
+                    for item in page['imdata']:
+                        attributes = item['ethpmPhysIf']['attributes']
+                        g.add((host, attributes['dn']), attributes['resetCtr'])
+                        metric_counter += 1
+            except IncompleteResponse as e:
+                LOG.warning("Skipping apic host %s: %s", host, e)
+                g = self.__reset_counter.builder()
+                metric_counter = 0
+                continue
             break  # Each host produces the same metrics.
+        else:
+            self.mark_incomplete("no apic host returned the interface metrics")
 
-        yield g
+        yield g.build()
 
         LOG.info('Collected %s APIC interface metrics', metric_counter)
@@ -1,4 +1,5 @@
 from Collector import Collector
+from modules.Topology import fabric_node
 import logging
 from prometheus_client.core import GaugeMetricFamily
 from typing import List, Dict
@@ -10,8 +11,6 @@ class ApicLeafCapacityCollector(Collector):
 
     def __init__(self, config: Dict):
         super().__init__('apic_leaf_capacity', config)
-        self.leaf_ids = {}
-        self.gen1_leaves = {}
 
     def describe(self):
         yield GaugeMetricFamily('network_apic_leaf_capacity',
@@ -29,19 +28,24 @@ class ApicLeafCapacityCollector(Collector):
         g_leaf_cap_tcam = GaugeMetricFamily('network_apic_leaf_capacity_tcam',
                                             'ACI Leaf IPv4 EndPoint TCAM capacity available',
                                             labels=['aciLeaf', 'usage', 'layer'])
-        if not self.leaf_ids:
-            self.leaf_ids = self._get_leaf_ids(host)
-        if not self.gen1_leaves:
-            self.gen1_leaves = self._get_gen1_leaves(host)
+        nodes = self.get_fabric_nodes(host)
+        if nodes is None:
+            return None
+        leaf_ids = self._get_leaf_ids(nodes)
+        gen1_leaves = self._get_gen1_leaves(nodes)
+        node_ids = {'node-' + node.id for node in nodes}
         for leaf in data['imdata']:
             if 'eqptcapacityEntity' in leaf and 'children' in leaf['eqptcapacityEntity']:
                 """Ignore spine switches without children data"""
                 leaf_data = leaf['eqptcapacityEntity']['children']
                 leaf_dn = leaf['eqptcapacityEntity']['attributes']['dn'].split('/')
                 leaf_id = leaf_dn[2]
-                if not self.leaf_ids.get(leaf_id, False):
+                if leaf_id not in node_ids:
+                    # a node was added to the fabric since the topology was fetched
+                    self.topology.invalidate()
+                if not leaf_ids.get(leaf_id, False):
                     continue
-                if not self.gen1_leaves.get(leaf_id, False):
+                if not gen1_leaves.get(leaf_id, False):
                     for data_object in leaf_data:
                         if 'eqptcapacityL3TotalUsageCap5min' in data_object:
                             l3_max = data_object['eqptcapacityL3TotalUsageCap5min']['attributes']['v4TotalEpCapMax']
@@ -107,23 +111,18 @@ class ApicLeafCapacityCollector(Collector):
                     g_leaf_cap_tcam.add_metric(labels=[leaf_id, 'total', 'l2'], value=l2_total)
         return [g_leaf_cap_tcam]
 
-    def _get_leaf_ids(self, host: str) -> Dict:
-        '''_get_leaf_ids queries the apic for all fabricNodes with role="leaf" and returns a map containing leaf ids'''
-        result = self.query_host(host, '/api/node/class/fabricNode.json?query-target-filter=eq(fabricNode.role,"leaf")')
+    def _get_leaf_ids(self, nodes: List[fabric_node]) -> Dict:
+        '''_get_leaf_ids returns a map containing the ids of all fabricNodes with role="leaf"'''
         leaf_ids = {}
-        for leaf in result['imdata']:
-            leaf_id = leaf['fabricNode']['attributes']['dn'].split('/')[2]
-            leaf_ids[leaf_id] = True
+        for leaf in nodes:
+            if leaf.role == 'leaf':
+                leaf_ids[leaf.dn.split('/')[2]] = True
         return leaf_ids
 
-    def _get_gen1_leaves(self, host: str) -> Dict:
+    def _get_gen1_leaves(self, nodes: List[fabric_node]) -> Dict:
         '''filter for generation 1 leaf models'''
-        result = self.query_host(host, '/api/node/class/fabricNode.json' +
-                                       '?query-target-filter=and(' +
-                                       'or(wcard(fabricNode.model,"PQ"),wcard(fabricNode.model,"PX"))' +
-                                       ',eq(fabricNode.role,"leaf"))')
         gen1_leaves = {}
-        for leaf in result['imdata']:
-            leaf_id = leaf['fabricNode']['attributes']['dn'].split('/')[2]
-            gen1_leaves[leaf_id] = True
+        for leaf in nodes:
+            if leaf.role == 'leaf' and ('PQ' in leaf.model or 'PX' in leaf.model):
+                gen1_leaves[leaf.dn.split('/')[2]] = True
         return gen1_leaves
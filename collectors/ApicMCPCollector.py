@@ -1,57 +1,156 @@
 import logging
+import threading
+import time
 
-from prometheus_client.core import CounterMetricFamily, Summary
+from urllib.parse import quote
+from prometheus_client.core import Summary
+from modules.MetricBuilder import SeriesCache
+from modules.Transport import IncompleteResponse
 import BaseCollector
+from typing import Dict, Iterator, List
 
 LOG = logging.getLogger('apic_exporter.exporter')
 REQUEST_TIME = Summary('apic_mcp_faults_processing_seconds',
                        'Time spent processing request')
+MCP_RESYNC = 600
+MCP_CODES = "or(eq(faultInst.code,\"F2533\"),eq(faultInst.code,\"F2534\"))"
+MCP_LIFECYCLES = ('raised', 'soaking')
 
 
 class ApicMCPCollector(BaseCollector.BaseCollector):
+    def __init__(self, config: Dict):
+        super().__init__(config)
+        self.__subscription_mode = bool(config.get('subscription_mode', False))
+        self.__query_mode = config.get('mcp_query_mode', 'full')
+        self.__resync = int(config.get('mcp_resync', MCP_RESYNC))
+        self.__mcp_faults = SeriesCache('network_apic_mcp_fault_counter',
+                                        'Counter for MCP Faults',
+                                        ['apicHost', 'fault_summary', 'fault_desc', 'fault_lifecyle'], 'counter')
+
+        # raised and soaking faults by dn, kept in incremental mode
+        self.__faults: Dict[str, Dict] = {}
+        self.__last_modified: str = None
+        self.__synced_at: float = None
+        self.__sync_lock = threading.Lock()
+
     def describe(self):
-        yield CounterMetricFamily('network_apic_mcp_fault_counter',
-                                  'Counter for MCP Faults')
+        yield self.__mcp_faults.describe()
 
     @REQUEST_TIME.time()
     def collect(self):
         LOG.debug('Collecting APIC MCP Fault metrics ...')
 
-        c_mcp_faults = CounterMetricFamily(
-            'network_apic_mcp_fault_counter',
-            'Counter for MCP Faults',
-            labels=['apicHost', 'fault_summary', 'fault_desc', 'fault_lifecyle'])
+        c_mcp_faults = self.__mcp_faults.builder()
 
         metric_counter = 0
-        query = "/api/node/class/faultInst.json" + \
-                "?query-target-filter=or(eq(faultInst.code,\"F2533\"),eq(faultInst.code,\"F2534\"))"
         for host in self.hosts:
-            fetched_data = self.query_host(host, query)
-            if fetched_data is None:
-                LOG.warning(
-                    "Skipping apic host %s, %s did not return anything", host, query)
+            if self.__query_mode == 'incremental' and not self.__subscription_mode:
+                faults = self._sync_faults(host)
+            else:
+                faults = self._fetch_faults(host)
+            if faults is None:
+                LOG.warning("Skipping apic host %s, MCP faults are not available", host)
                 continue
 
-            if len(fetched_data['imdata']) == 0:
+            try:
+                for fault in faults:
+                    # the subscription store may still hold faults that left the lifecycles of the query
+                    if fault['lc'] in MCP_LIFECYCLES:
+                        LOG.debug("host: %s, fault: %s, lifecycle: %s, desc: %s", host, fault['dn'], fault['lc'],
+                                  fault['descr'])
+                        metric_counter += 1
+
+                        c_mcp_faults.add((host, fault['dn'], fault['descr'], fault['lc']), 1)
+            except IncompleteResponse as e:
+                LOG.warning("Skipping apic host %s: %s", host, e)
+                c_mcp_faults = self.__mcp_faults.builder()
+                metric_counter = 0
+                continue
+
+            if metric_counter == 0:
                 # Add Empty Counter to have the metric show up in Prometheus.
                 # Otherwise they only show when something is wrong and we dont know if it is actually working
-                c_mcp_faults.add_metric(labels=[host, '', '', ''], value=0)
-                metric_counter += 1
-                break  # Each host produces the same metrics.
-            count = int(fetched_data['totalCount'])
-            for x in range(0, int(count)):
-                if (fetched_data['imdata'][x]['faultInst']['attributes']['lc'] == 'raised'
-                   or fetched_data['imdata'][x]['faultInst']['attributes']['lc'] == 'soaking'):
-                    fault_lifecyle = fetched_data['imdata'][x]['faultInst']['attributes']['lc']
-                    fault_summary = fetched_data['imdata'][x]['faultInst']['attributes']['dn']
-                    fault_desc = fetched_data['imdata'][x]['faultInst']['attributes']['descr']
-
-                    LOG.debug("host: %s", fault_lifecyle, fault_summary, fault_desc)
-                    metric_counter += 1
-
-                    c_mcp_faults.add_metric(labels=[host, fault_summary, fault_desc, fault_lifecyle], value=1)
+                c_mcp_faults.add((host, '', '', ''), 0)
             break  # Each host produces the same metrics.
+        else:
+            self.mark_incomplete("no apic host returned the MCP fault metrics")
 
-        yield c_mcp_faults
+        yield c_mcp_faults.build()
 
         LOG.info('Collected %s APIC MCP Fault metrics', metric_counter)
+
+    def _fetch_faults(self, host: str) -> Iterator[Dict]:
+        """The attributes of all raised and soaking MCP faults, filtered by the APIC"""
+        query = self._query(lifecycle_filter())
+        if self.__subscription_mode:
+            pages = self.query_host_subscribed(host, query)
+        else:
+            pages = self.query_host_paged(host, query)
+        if pages is None:
+            return None
+        return (item['faultInst']['attributes'] for page in pages for item in page['imdata'])
+
+    def _sync_faults(self, host: str) -> List[Dict]:
+        """Updates the local fault table with the faults modified since the newest fault seen so far and
+           returns its faults ordered by dn. The table is rebuilt from all raised and soaking faults on the
+           first sync and every mcp_resync seconds, which also drops faults deleted in between.
+           A sync that did not receive every fault keeps the previous table and forces a full sync next time,
+           since the missing faults may be older than the newest fault received. A page that is not returned
+           also skips the host."""
+        with self.__sync_lock:
+            full = self.__last_modified is None or time.monotonic() - self.__synced_at >= self.__resync
+            if full:
+                query = self._query(lifecycle_filter())
+            else:
+                # modified faults of any lifecycle, to notice the ones that are no longer raised or soaking
+                query = self._query('ge(faultInst.modTs,"%s")' % quote(self.__last_modified, safe=''))
+            pages = self.query_host_paged(host, query)
+            if pages is None:
+                return None
+
+            faults = {} if full else dict(self.__faults)
+            last_modified = None if full else self.__last_modified
+            changes = 0
+            total = 0
+            try:
+                for page in pages:
+                    total = int(page.get('totalCount', 0))
+                    for item in page['imdata']:
+                        fault = item['faultInst']['attributes']
+                        if fault['lc'] in MCP_LIFECYCLES:
+                            faults[fault['dn']] = fault
+                        else:
+                            faults.pop(fault['dn'], None)
+                        if last_modified is None or fault['modTs'] > last_modified:
+                            last_modified = fault['modTs']
+                        changes += 1
+            except IncompleteResponse as e:
+                LOG.warning("%s sync of MCP faults on %s failed, a full sync follows: %s",
+                            'Full' if full else 'Incremental', host, e)
+                self.__last_modified = None
+                return None
+
+            if changes != total:
+                LOG.warning("%s sync of MCP faults on %s received %s of %s faults, a full sync follows",
+                            'Full' if full else 'Incremental', host, changes, total)
+                self.__last_modified = None
+                if self.__synced_at is None:
+                    return None
+                return [self.__faults[dn] for dn in sorted(self.__faults)]
+
+            LOG.debug("%s sync of MCP faults on %s: %s faults received, %s in table",
+                      'Full' if full else 'Incremental', host, changes, len(faults))
+            self.__faults = faults
+            self.__last_modified = last_modified
+            if full:
+                self.__synced_at = time.monotonic()
+            return [faults[dn] for dn in sorted(faults)]
+
+    def _query(self, condition: str) -> str:
+        return "/api/node/class/faultInst.json" + \
+               "?query-target-filter=and(" + MCP_CODES + "," + condition + ")" + \
+               "&order-by=faultInst.dn"
+
+
+def lifecycle_filter() -> str:
+    return "or(" + ",".join('eq(faultInst.lc,"%s")' % lc for lc in MCP_LIFECYCLES) + ")"
@@ -1,119 +1,14 @@
-import logging
-import re
+import os
 
-import BaseCollector
-from prometheus_client.core import GaugeMetricFamily, Summary
+from DefinitionCollector import DefinitionCollector
+from modules.Definitions import load_definitions
+from typing import Dict
 
-LOG = logging.getLogger('apic_exporter.exporter')
-REQUEST_TIME = Summary('apic_processes_processing_seconds',
-                       'Time spent processing request')
+DEFINITIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'definitions', 'processes.yaml')
 
 
-class ApicProcessesCollector(BaseCollector.BaseCollector):
-    def describe(self):
-        yield GaugeMetricFamily('network_apic_process_memory_used_min_kb',
-                                'Minimum memory used by process')
-
-        yield GaugeMetricFamily('network_apic_process_memory_used_max_kb',
-                                'Maximum memory used by process')
-
-        yield GaugeMetricFamily('network_apic_process_memory_used_avg_kb',
-                                'Average memory used by process')
-
-    @REQUEST_TIME.time()
-    def collect(self):
-        LOG.debug('Collecting APIC processes metrics ...')
-
-        g_mem_min = GaugeMetricFamily(
-            'network_apic_process_memory_used_min_kb',
-            'Minimum memory used by process',
-            labels=['apicHost', 'procName', 'nodeId', 'nodeRole'])
-
-        g_mem_max = GaugeMetricFamily(
-            'network_apic_process_memory_used_max_kb',
-            'Maximum memory used by process',
-            labels=['apicHost', 'procName', 'nodeId', 'nodeRole'])
-
-        g_mem_avg = GaugeMetricFamily(
-            'network_apic_process_memory_used_avg_kb',
-            'Average memory used by process',
-            labels=['apicHost', 'procName', 'nodeId', 'nodeRole'])
-
-        metric_counter = 0
-        query = '/api/node/class/fabricNode.json?'
-        for host in self.hosts:
-            fetched_data = self.query_host(host, query)
-            if fetched_data is None:
-                LOG.warning(
-                    "Skipping apic host %s, %s did not return anything", host,
-                    query)
-                continue
-
-            # fetch nfm process id from each node
-            for node in fetched_data['imdata']:
-                node_dn = node['fabricNode']['attributes']['dn']
-                node_role = node['fabricNode']['attributes']['role']
-                LOG.debug("Fetching process data for node %s %s", node_dn,
-                          node_role)
-
-                proc_query = '/api/node/class/' + node_dn + '/procProc.json?query-target-filter=eq(procProc.name,"nfm")'
-                proc_data = self.query_host(host, proc_query)
-                if proc_data is None:
-                    LOG.info("Apic host %s node %s has no nfm process", host,
-                             node_dn)
-                    continue
-
-                # fetch nfm process memory consumption per node
-                if int(proc_data['totalCount']) > 0:
-                    proc_dn = proc_data['imdata'][0]['procProc']['attributes'][
-                        'dn']
-                    proc_name = proc_data['imdata'][0]['procProc'][
-                        'attributes']['name']
-                    mem_query = '/api/node/mo/' + proc_dn + '/HDprocProcMem5min-0.json'
-                    mem_data = self.query_host(host, mem_query)
-                    if mem_data is None:
-                        LOG.info(
-                            "Apic host %s node %s process %s has no memory data",
-                            host, node_dn, proc_dn)
-                        continue
-
-                    if int(mem_data['totalCount']) > 0:
-                        node_id = self._parseNodeIdInProcDN(proc_dn)
-
-                        LOG.debug(
-                            "procName: %s, nodeId: %s, role: %s, MemUsedMin: %s, MemUsedMax: %s, MemUsedAvg: %s",
-                            proc_name, node_id, node_role,
-                            mem_data['imdata'][0]['procProcMemHist5min']['attributes']['usedMin'],
-                            mem_data['imdata'][0]['procProcMemHist5min']['attributes']['usedMax'],
-                            mem_data['imdata'][0]['procProcMemHist5min']['attributes']['usedAvg'])
-
-                        # Min memory used
-                        g_mem_min.add_metric(
-                            labels=[host, proc_name, node_id, node_role],
-                            value=mem_data['imdata'][0]['procProcMemHist5min']['attributes']['usedMin'])
-
-                        # Max memory used
-                        g_mem_max.add_metric(
-                            labels=[host, proc_name, node_id, node_role],
-                            value=mem_data['imdata'][0]['procProcMemHist5min']['attributes']['usedMax'])
-
-                        # Avg memory used
-                        g_mem_avg.add_metric(
-                            labels=[host, proc_name, node_id, node_role],
-                            value=mem_data['imdata'][0]['procProcMemHist5min']['attributes']['usedAvg'])
-
-                        metric_counter += 3
-            break  # Each host produces the same metrics.
-
-        yield g_mem_min
-        yield g_mem_max
-        yield g_mem_avg
-
-        LOG.info('Collected %s APIC processes metrics', metric_counter)
-
-    def _parseNodeIdInProcDN(self, procDn):
-        nodeId = ''
-        matchObj = re.match(u".+node-([0-9]*).+", procDn)
-        if matchObj:
-            nodeId = matchObj.group(1)
-        return nodeId
+class ApicProcessesCollector(DefinitionCollector):
+    def __init__(self, config: Dict):
+        """Memory consumption of the nfm process on every fabric node, see definitions/processes.yaml"""
+        definitions = [d for d in load_definitions(DEFINITIONS) if d['name'] == 'nfm']
+        super().__init__('apic_processes', config, definitions, config.get('process_query_mode', 'node'))
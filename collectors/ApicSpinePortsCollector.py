@@ -1,7 +1,9 @@
 import logging
 from Collector import Collector
 from prometheus_client.core import GaugeMetricFamily
-from typing import Dict, List
+from modules.Topology import fabric_node
+from modules.Transport import IncompleteResponse
+from typing import Dict, Iterator, List
 
 LOG = logging.getLogger('apic_exporter.exporter')
 
@@ -9,6 +11,7 @@ LOG = logging.getLogger('apic_exporter.exporter')
 class ApicSpinePortsCollector(Collector):
     def __init__(self, config: Dict):
         super().__init__('apic_spine_ports', config)
+        self.__query_mode = config.get('spine_ports_query_mode', 'node')
 
     def describe(self):
         yield GaugeMetricFamily('network_apic_free_port_count',
@@ -21,8 +24,8 @@ class ApicSpinePortsCollector(Collector):
                                 'In-use but down ports')
 
     def get_query(self) -> str:
-        return '/api/node/class/fabricNode.json?' + \
-               '&query-target-filter=eq(fabricNode.role,"spine")&order-by=fabricNode.id|asc'
+        # spines are taken from the topology cache
+        return None
 
     def get_metrics(self, host: str, data: Dict) -> List[GaugeMetricFamily]:
 
@@ -41,11 +44,24 @@ class ApicSpinePortsCollector(Collector):
             'In-use but down ports',
             labels=['apicHost', 'Spine_id', 'pod_id'])
 
-        count = data['totalCount']
-        spine_dn_list = []
-        for x in range(0, int(count)):
-            dn = str(data['imdata'][x]['fabricNode']['attributes']['dn'])
-            spine_dn_list.append(str(dn))
+        spines = self.get_fabric_nodes(host, 'spine')
+        if spines is None:
+            return None
+        spines = sorted(spines, key=lambda spine: int(spine.id))
+
+        if self.__query_mode == 'class':
+            # fetch the physical ports of all spines with a single class query
+            counts = self._count_fabric_ports(host, spines)
+            if counts is None:
+                return None
+            for spine in spines:
+                free_port_count, used_port_count, down_port_count = counts[spine.dn]
+                g_free_port.add_metric(labels=[host, spine.id, spine.pod], value=free_port_count)
+                g_used_port.add_metric(labels=[host, spine.id, spine.pod], value=used_port_count)
+                g_down_port.add_metric(labels=[host, spine.id, spine.pod], value=down_port_count)
+            return [g_free_port, g_used_port, g_down_port]
+
+        spine_dn_list = [spine.dn for spine in spines]
 
         # fetch physcal port from each spine
         for dn in spine_dn_list:
@@ -54,8 +70,9 @@ class ApicSpinePortsCollector(Collector):
             used_port = []
             down_port = []
 
-            output = self.query_host(host, query_url)
+            output = self.query_host_stream(host, query_url)
             if output is None:
+                self.mark_incomplete("apic host %s did not return the ports of %s" % (host, dn))
                 continue
 
             for x in output['imdata']:
@@ -95,3 +112,46 @@ class ApicSpinePortsCollector(Collector):
                 value=down_port_count)
 
         return [g_free_port, g_used_port, g_down_port]
+
+    def _count_fabric_ports(self, host: str, spines: List[fabric_node]) -> Dict[str, List[int]]:
+        """Counts the free, used and down ports per spine dn from the l1PhysIf of all spines
+           including their ethpmPhysIf, fetched page by page"""
+        counts = {spine.dn: [0, 0, 0] for spine in spines}
+        if not spines:
+            return counts
+        spine_filter = ','.join('wcard(l1PhysIf.dn,"^%s/")' % spine.dn for spine in spines)
+        if len(spines) > 1:
+            spine_filter = 'or(' + spine_filter + ')'
+        query = '/api/node/class/l1PhysIf.json?query-target-filter=' + spine_filter + \
+                '&rsp-subtree=children&rsp-subtree-class=ethpmPhysIf&order-by=l1PhysIf.dn'
+        pages = self.query_host_paged(host, query)
+        if pages is None:
+            return None
+
+        try:
+            for port in self._iterate_ports(pages):
+                attributes = port['attributes']
+                spine_dn, _, _ = attributes['dn'].partition('/sys/')
+                if spine_dn not in counts:
+                    continue
+                oper_state = None
+                for child in port.get('children', ()):
+                    if 'ethpmPhysIf' in child:
+                        oper_state = child['ethpmPhysIf']['attributes']['operSt']
+                        break
+                if attributes['adminSt'] == 'up' and oper_state == 'down':
+                    counts[spine_dn][0] += 1
+                elif attributes['adminSt'] == 'up' and oper_state == 'up':
+                    counts[spine_dn][1] += 1
+                elif attributes['adminSt'] == 'down':
+                    counts[spine_dn][2] += 1
+        except IncompleteResponse as e:
+            LOG.warning("Skipping apic host %s: %s", host, e)
+            return None
+        return counts
+
+    def _iterate_ports(self, pages: Iterator[Dict]) -> Iterator[Dict]:
+        for page in pages:
+            for item in page['imdata']:
+                if 'l1PhysIf' in item:
+                    yield item['l1PhysIf']
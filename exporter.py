@@ -1,6 +1,7 @@
 import yaml
 import logging
 import os
+import re
 import sys
 import time
 import click
@@ -9,14 +10,110 @@ import pkgutil
 
 from prometheus_client.core import REGISTRY
 from prometheus_client import start_http_server
+from modules.Scheduler import CachedCollector, CollectorScheduler, COLLECTION_INTERVAL
+from modules.WorkerPool import ParallelCollector
+from modules.Probe import FabricTarget, start_probe_server
+from modules.Exposition import CachedExposition, start_cached_server
+from modules import JsonDecoder
+from modules.Deadline import DeadlineCollector, DeadlineStatus
 
 LOG = logging.getLogger('apic_exporter.exporter')
+# collectors that only collect what is configured, hence they have to be listed in the collectors explicitly
+OPT_IN_COLLECTORS = {'ApicDefinedCollector'}
+
+
+def run_prometheus_server(port, collectors, exporter_config):
+    """collectors maps the collector name to the collector and its settings from the config"""
+    deadline_status = DeadlineStatus()
+    collectors = get_deadline_collectors(collectors, exporter_config, deadline_status)
+    if any(isinstance(c, DeadlineCollector) for c, _ in collectors.values()):
+        REGISTRY.register(deadline_status)
+    if exporter_config.get('collection_mode', 'scrape') == 'background':
+        interval = int(exporter_config.get('collection_interval', COLLECTION_INTERVAL))
+        LOG.info("Collecting in the background every %s seconds", interval)
+        scheduler = CollectorScheduler({name: get_cached_collector(name, c, settings, interval)
+                                        for name, (c, settings) in collectors.items()})
+        # the snapshots are rendered once per collection, the exporter's own metrics on every scrape
+        REGISTRY.register(scheduler.status)
+        start_cached_server(int(port), CachedExposition(scheduler, scheduler.version))
+        scheduler.start()
+        return wait_forever()
 
-
-def run_prometheus_server(port, collectors):
     start_http_server(int(port))
-    for c in collectors:
-        REGISTRY.register(c)
+    scraped = get_scraped_collectors(collectors)
+    if int(exporter_config.get('workers', 1)) > 1:
+        workers = int(exporter_config['workers'])
+        LOG.info("Running collectors in parallel on %s workers", workers)
+        REGISTRY.register(ParallelCollector(scraped, workers))
+    else:
+        for c in scraped.values():
+            REGISTRY.register(c)
+    wait_forever()
+
+
+def run_probe_server(port, fabrics, exporter_config):
+    """fabrics maps the fabric name to its collectors, each fabric is scraped through /probe?target=<fabric>"""
+    if exporter_config.get('collection_mode', 'scrape') == 'background':
+        LOG.warning("collection_mode background is not supported with fabrics, collectors run on every probe")
+    targets = {}
+    # the partial collections of all fabrics are served with the exporter's own metrics
+    deadline_status = DeadlineStatus(['target', 'collector'])
+    limited = False
+    for fabric, (collectors, apic_config) in fabrics.items():
+        collectors = get_deadline_collectors(collectors, exporter_config, deadline_status, fabric)
+        workers = int(apic_config.get('workers', exporter_config.get('workers', 1)))
+        targets[fabric] = FabricTarget(fabric, get_scraped_collectors(collectors), workers)
+        limited = limited or any(isinstance(c, DeadlineCollector) for c, _ in collectors.values())
+    if limited:
+        REGISTRY.register(deadline_status)
+    start_probe_server(int(port), targets)
+    wait_forever()
+
+
+def get_deadline_collectors(collectors, exporter_config, status, fabric=None):
+    """Collectors with a deadline, their own or the one of the exporter section, run within that many seconds
+       and yield partial results once it is exceeded. Whether they did is reported to status, by fabric and
+       collector name if a fabric is given."""
+    limited = {}
+    for name, (c, settings) in collectors.items():
+        deadline = settings.get('deadline', exporter_config.get('deadline'))
+        if deadline is not None:
+            LOG.info("Collector %s has a deadline of %s seconds", name, deadline)
+            labels = (fabric, name) if fabric is not None else (name,)
+            c = DeadlineCollector(name, c, float(deadline), status, labels)
+        limited[name] = (c, settings)
+    return limited
+
+
+def get_scraped_collectors(collectors):
+    """Collectors with their own interval or timeout serve cached results in between"""
+    scraped = {}
+    for name, (c, settings) in collectors.items():
+        if 'interval' in settings or 'timeout' in settings:
+            scraped[name] = get_cached_collector(name, c, settings, 0)
+        else:
+            scraped[name] = c
+    return scraped
+
+
+def initialize_collectors(collector_settings, apic_config):
+    """Returns the collectors of the config by name together with their settings"""
+    collectors = {}
+    for settings in collector_settings:
+        collector = initialize_collector_by_name(settings['name'], apic_config)
+        if collector is not None:
+            collectors[settings['name']] = (collector, settings)
+    return collectors
+
+
+def get_cached_collector(name, collector, settings, default_interval):
+    interval = int(settings.get('interval', default_interval))
+    timeout = int(settings['timeout']) if 'timeout' in settings else None
+    LOG.info("Collector %s runs every %s seconds with timeout %s", name, interval, timeout)
+    return CachedCollector(name, collector, interval, timeout)
+
+
+def wait_forever():
     while True:
         time.sleep(1)
 
@@ -36,6 +133,16 @@ def get_config(config_file):
         elif len(config['collectors']) == 0:
             LOG.error("Empty list of collectors")
             exit(1)
+        # collectors are either given by name or as a mapping with name, interval and timeout
+        config['collectors'] = [c if isinstance(c, dict) else {'name': c} for c in config['collectors']]
+
+        if 'fabrics' in config:
+            # every fabric inherits the settings of the aci section
+            config['fabrics'] = {name: dict(config.get('aci', {}), **(fabric or {}))
+                                 for name, fabric in config['fabrics'].items()}
+            for name, fabric in config['fabrics'].items():
+                fabric['apic_password'] = get_fabric_password(name)
+            return config
 
         # load apic password from environment
         pw = os.getenv('APIC_PASSWORD')
@@ -54,8 +161,19 @@ def get_config(config_file):
         exit(1)
 
 
+def get_fabric_password(fabric):
+    """The password of a fabric is read from APIC_PASSWORD_<FABRIC>, e.g. APIC_PASSWORD_EU_DE_1 for eu-de-1,
+       and falls back to APIC_PASSWORD"""
+    env = 'APIC_PASSWORD_' + re.sub(r'[^A-Z0-9]', '_', fabric.upper())
+    pw = os.getenv(env, os.getenv('APIC_PASSWORD'))
+    if pw is None:
+        LOG.error("envvar '%s' or 'APIC_PASSWORD' not set", env)
+        exit(1)
+    return pw
+
+
 def get_default_collectors():
-    return [name for _, name, _ in pkgutil.iter_modules(['collectors'])]
+    return [name for _, name, _ in pkgutil.iter_modules(['collectors']) if name not in OPT_IN_COLLECTORS]
 
 
 def initialize_collector_by_name(class_name, config):
@@ -88,9 +206,13 @@ def main(port, config):
 
     config_obj = get_config(config)
     exporter_config = config_obj['exporter']
-    apic_config = config_obj['aci']
 
-    collectors = list(map(lambda c: initialize_collector_by_name(c, apic_config), config_obj['collectors']))
+    if 'fabrics' in config_obj:
+        fabrics = {name: (initialize_collectors(config_obj['collectors'], apic_config), apic_config)
+                   for name, apic_config in config_obj['fabrics'].items()}
+    else:
+        apic_config = config_obj['aci']
+        collectors = initialize_collectors(config_obj['collectors'], apic_config)
 
     level = logging.getLevelName("INFO")
     if exporter_config['log_level']:
@@ -100,9 +222,16 @@ def main(port, config):
     logging.basicConfig(stream=sys.stdout, format=format, level=level)
 
     LOG.info("Starting Apic Exporter on port={} config={}".format(port, config))
-    LOG.info("APIC Exporter connects to APIC hosts: %s", apic_config['apic_hosts'])
-
-    run_prometheus_server(port, collectors)
+    if exporter_config.get('json_backend'):
+        JsonDecoder.set_backend(exporter_config['json_backend'])
+    LOG.info("Decoding APIC responses with %s", JsonDecoder.backend)
+    if 'fabrics' in config_obj:
+        for name, (_, apic_config) in fabrics.items():
+            LOG.info("APIC Exporter connects to fabric %s APIC hosts: %s", name, apic_config['apic_hosts'])
+        run_probe_server(port, fabrics, exporter_config)
+    else:
+        LOG.info("APIC Exporter connects to APIC hosts: %s", apic_config['apic_hosts'])
+        run_prometheus_server(port, collectors, exporter_config)
 
 
 if __name__ == '__main__':
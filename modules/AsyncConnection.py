@@ -0,0 +1,373 @@
+import aiohttp
+import asyncio
+import logging
+import threading
+import time
+
+from modules import JsonDecoder
+from modules.PerFabric import per_fabric
+from modules.Connection import TIMEOUT, COOKIE_TIMEOUT, COALESCED_REQUESTS, TOKEN_LIFETIME, TOKEN_REFRESH_RATIO, \
+    MAX_REFRESH_SLEEP, SESSION_AGE, TOKEN_REFRESHES, TOKEN_REFRESH_FAILURES
+from modules.HostSelector import HostSelector
+from modules.CircuitBreaker import CircuitBreakers
+from modules.Deadline import budget_exhausted, request_timeout
+from modules.Transport import CONNECTION_POOL_SIZE, accept_encoding, connection_trace, decompress
+from modules.Instrumentation import QUERY_DURATION, QUERY_TIMEOUTS, QUERY_TOKEN_RETRIES, \
+    observe_response, query_class
+
+from typing import List, Dict, Tuple
+
+LOG = logging.getLogger('apic_exporter.exporter')
+MAX_CONCURRENT_REQUESTS = 16
+POOL_LOCK = threading.Lock()
+REQUESTS_IN_FLIGHT: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+@per_fabric
+class AsyncSessionPool(object):
+    def __init__(self, hosts, user, password, max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                 pool_size=CONNECTION_POOL_SIZE, compression=True):
+        """Initializes the asyncio Session Pool on its own event loop thread.
+           Keeps a token and a concurrency limit per host, up to pool_size connections per host and asks for
+           gzip compressed responses if compression is set. Failing hosts are skipped by their circuit
+           breakers and logged into again in the background."""
+        self.__hosts = list(hosts)
+        self.__user = user
+        self.__password = password
+        self.__max_concurrent_requests = max_concurrent_requests
+        self.__pool_size = pool_size
+        self.__compression = compression
+        self.__tokens: Dict[str, str] = {}
+        self.__breakers = CircuitBreakers(hosts)
+        self.__semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.__login_locks: Dict[str, asyncio.Lock] = {}
+        self.__issued: Dict[str, float] = {}
+        self.__refresh_at: Dict[str, float] = {}
+        self.__session: aiohttp.ClientSession = None
+
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, name='apic-async', daemon=True)
+        thread.start()
+        self.run(self.__initialize())
+
+    def run(self, coro):
+        """Runs the coroutine on the pool's event loop and blocks until it is done"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def start(self, coro):
+        """Schedules the coroutine on the pool's event loop without waiting for it"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def __initialize(self):
+        """Creates the HTTP session and logs into every host concurrently"""
+        connector = aiohttp.TCPConnector(ssl=False, limit=0, limit_per_host=self.__pool_size)
+        # responses are decompressed by the exporter to account for the transferred bytes
+        self.__session = aiohttp.ClientSession(connector=connector, trust_env=False, auto_decompress=False,
+                                               headers={'Accept-Encoding': accept_encoding(self.__compression)},
+                                               trace_configs=[connection_trace()])
+        for host in self.__hosts:
+            self.__semaphores[host] = asyncio.Semaphore(self.__max_concurrent_requests)
+            self.__login_locks[host] = asyncio.Lock()
+        await asyncio.gather(*[self.__login(host) for host in self.__hosts])
+        asyncio.ensure_future(self.__refresh_loop())
+
+    async def __login(self, host: str, timeout: float = COOKIE_TIMEOUT):
+        token = await self.requestCookie(host, timeout)
+        if token is None and budget_exhausted():
+            # the login was cut short by the deadline of the collection, not by the host
+            LOG.warning("Login to %s was cancelled, the collection ran out of time", host)
+            return
+        self.__tokens[host] = token
+        if token is None:
+            self.__breakers.record_failure(host)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.__session
+
+    def semaphore(self, host: str) -> asyncio.Semaphore:
+        return self.__semaphores[host]
+
+    async def getSession(self, host: str) -> Tuple[str, bool]:
+        """Returns the token and availability. A host is available while its circuit is closed. Without a
+           token although the circuit is closed, because a login of the requests sessions closed it, it logs
+           in first."""
+        token = self.__tokens.get(host)
+        if not self.__breakers.allows(host):
+            return token, False
+        if token is None:
+            token = await self.refreshCookie(host, None)
+        return token, token is not None and self.__breakers.allows(host)
+
+    def get_unavailable_sessions(self) -> List[str]:
+        return [host for host in self.__hosts if not self.__breakers.allows(host)]
+
+    def set_session_unavailable(self, host: str):
+        """Opens the circuit of a host that failed to respond, queries skip it until a background login
+           succeeds"""
+        if host in self.__tokens:
+            LOG.debug("Flag host %s as unavailable", host)
+            self.__breakers.record_failure(host)
+
+    async def refreshCookie(self, host: str, stale_token: str) -> str:
+        """Requests a fresh token unless a concurrent request already replaced the stale one. The login is
+           capped by the budget of the collection and keeps the stale token if the budget runs out."""
+        async with self.__login_locks[host]:
+            timeout = request_timeout(COOKIE_TIMEOUT)
+            if self.__tokens.get(host) == stale_token and timeout > 0:
+                await self.__login(host, timeout)
+            return self.__tokens.get(host)
+
+    async def requestCookie(self, host: str, timeout: float = COOKIE_TIMEOUT) -> str:
+        """Login to the host and retrieve cookie"""
+        LOG.info("Request token for %s", host)
+
+        url = "https://" + host + "/api/aaaLogin.json?"
+        payload = {
+            "aaaUser": {
+                "attributes": {
+                    "name": self.__user,
+                    "pwd": self.__password
+                }
+            }
+        }
+        try:
+            async with self.__session.post(url, json=payload, trace_request_ctx=host,
+                                           timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                status = resp.status
+                body = decompress(host, await resp.read(), resp.headers.get('Content-Encoding'))
+        except asyncio.TimeoutError:
+            if budget_exhausted():
+                return None
+            LOG.error("Connection with host %s timed out after %s sec", host,
+                      timeout)
+            return None
+        except (aiohttp.ClientError, ConnectionError) as e:
+            LOG.error("Cannot connect to %s: %s", url, e)
+            return None
+
+        cookie = None
+        if status == 200:
+            res = JsonDecoder.loads(body)
+            cookie = res['imdata'][0]['aaaLogin']['attributes']['token']
+            self.__token_issued(host, res['imdata'][0]['aaaLogin']['attributes'])
+        else:
+            LOG.error("url %s responds with %s", url, status)
+
+        return cookie
+
+    async def refreshToken(self, host: str, token: str) -> str:
+        """Extend the token with aaaRefresh and retrieve the renewed one"""
+        url = "https://" + host + "/api/aaaRefresh.json"
+        try:
+            async with self.__session.get(url, headers={'Cookie': 'APIC-cookie=' + token}, trace_request_ctx=host,
+                                          timeout=aiohttp.ClientTimeout(total=COOKIE_TIMEOUT)) as resp:
+                status = resp.status
+                body = decompress(host, await resp.read(), resp.headers.get('Content-Encoding'))
+        except asyncio.TimeoutError:
+            LOG.error("Connection with host %s timed out after %s sec", host,
+                      COOKIE_TIMEOUT)
+            return None
+        except (aiohttp.ClientError, ConnectionError) as e:
+            LOG.error("Cannot connect to %s: %s", url, e)
+            return None
+
+        if status != 200:
+            LOG.error("url %s responds with %s", url, status)
+            return None
+        res = JsonDecoder.loads(body)
+        self.__token_issued(host, res['imdata'][0]['aaaLogin']['attributes'])
+        return res['imdata'][0]['aaaLogin']['attributes']['token']
+
+    def __token_issued(self, host: str, attributes: Dict):
+        """Schedule the renewal of a new token ahead of its refresh timeout"""
+        now = time.monotonic()
+        lifetime = int(attributes.get('refreshTimeoutSeconds', TOKEN_LIFETIME))
+        self.__issued[host] = now
+        self.__refresh_at[host] = now + lifetime * TOKEN_REFRESH_RATIO
+        SESSION_AGE.labels(host, 'async').set_function(lambda: time.monotonic() - self.__issued[host])
+
+    async def __refresh_loop(self):
+        """Renews the tokens ahead of their expiry and tries hosts with an open circuit once their backoff
+           elapsed, so queries do not wait for authentication"""
+        while True:
+            now = time.monotonic()
+            # renewals of the other hosts may add to the schedule meanwhile
+            wakeups = [at for host, at in list(self.__refresh_at.items()) if self.__breakers.allows(host)]
+            next_trial = self.__breakers.next_trial()
+            if next_trial is not None:
+                wakeups.append(next_trial)
+            next_refresh = min(wakeups, default=now + MAX_REFRESH_SLEEP)
+            await asyncio.sleep(min(max(next_refresh - now, 1), MAX_REFRESH_SLEEP))
+            due = [host for host in self.__hosts
+                   if self.__breakers.trial_due(host) or (self.__breakers.allows(host) and
+                                                          self.__refresh_at.get(host, 0) <= time.monotonic())]
+            await asyncio.gather(*[self.__renew(host) for host in due])
+
+    async def __renew(self, host: str):
+        """Refreshes the host and records any error as a failure, which also ends a trial of its circuit"""
+        try:
+            await self.__refresh(host)
+        except Exception as e:
+            LOG.error("Renewing the token of %s failed: %s", host, e)
+            self.__breakers.record_failure(host)
+
+    async def __refresh(self, host: str):
+        """Renews the token of the host or logs in again and records the outcome in the host's circuit"""
+        async with self.__login_locks[host]:
+            token = self.__tokens.get(host)
+            if token is not None:
+                token = await self.refreshToken(host, token)
+                if token is None:
+                    TOKEN_REFRESH_FAILURES.labels(host, 'async').inc()
+                else:
+                    TOKEN_REFRESHES.labels(host, 'async').inc()
+            if token is None:
+                token = await self.requestCookie(host)
+            if token is None:
+                self.__breakers.record_failure(host)
+                return
+            self.__tokens[host] = token
+        self.__breakers.record_success(host)
+
+
+class AsyncConnection():
+    def __init__(self, hosts: List[str], user: str, password: str,
+                 max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS, collector: str = '',
+                 pool_size: int = CONNECTION_POOL_SIZE, compression: bool = True):
+        """collector is the name the queries of this connection are instrumented with"""
+        with POOL_LOCK:
+            self.__pool = AsyncSessionPool(hosts, user, password, max_concurrent_requests, pool_size, compression)
+        self.__selector = HostSelector(hosts)
+        self.__collector = collector
+
+    def run(self, coro):
+        """Runs the coroutine on the shared APIC event loop and waits for its result"""
+        return self.__pool.run(coro)
+
+    def start(self, coro):
+        """Schedules a long running coroutine on the shared APIC event loop"""
+        return self.__pool.start(coro)
+
+    async def openWebsocket(self, host: str) -> aiohttp.ClientWebSocketResponse:
+        """Opens the event websocket of the host with its current token. Returns None if it is not available"""
+        token, available = await self.__pool.getSession(host)
+        if not available:
+            LOG.info("Skipped websocket of unavailable host %s", host)
+            return None
+
+        url = "wss://" + host + "/socket" + token
+        try:
+            return await asyncio.wait_for(self.__pool.session.ws_connect(url, heartbeat=TIMEOUT), TIMEOUT)
+        except asyncio.TimeoutError:
+            LOG.error("Websocket of host %s timed out after %s sec", host, TIMEOUT)
+        except (aiohttp.ClientError, ConnectionError) as e:
+            LOG.error("Cannot open websocket of %s: %s", host, e)
+        return None
+
+    async def getRequest(self, host: str, query: str, timeout: int = TIMEOUT) -> Dict:
+        """Perform a GET request against host for the query. Retries if token is invalid.
+           Concurrent identical requests to the same host share one request and its decoded result, unless
+           the shared request ran out of the budget of the collection that issued it."""
+        key = (host, query)
+        request = REQUESTS_IN_FLIGHT.get(key)
+        shared = request is not None
+        if not shared:
+            request = asyncio.ensure_future(self.__flight(host, query, timeout))
+            REQUESTS_IN_FLIGHT[key] = request
+            request.add_done_callback(lambda _: REQUESTS_IN_FLIGHT.pop(key, None))
+        # a cancelled caller must not cancel the request for the other callers
+        res, out_of_time = await asyncio.shield(request)
+        if not shared:
+            return res
+        if out_of_time:
+            # the shared request ran out of the budget of the collection that issued it, not of this one
+            return await self.__getRequest(host, query, timeout)
+        COALESCED_REQUESTS.labels(host).inc()
+        return res
+
+    async def __flight(self, host: str, query: str, timeout: int) -> Tuple[Dict, bool]:
+        """Returns the result and whether the request was skipped or cut short by the budget"""
+        res = await self.__getRequest(host, query, timeout)
+        return res, res is None and budget_exhausted()
+
+    async def __getRequest(self, host: str, query: str, timeout: int) -> Dict:
+        """At most max_concurrent_requests requests per host are in flight at the same time."""
+        url = "https://" + host + query
+        labels = (self.__collector, host, query_class(query))
+
+        token, available = await self.__pool.getSession(host)
+
+        if not available:
+            LOG.info("Skipped unavailable host %s query %s", host, query)
+            return None
+
+        async with self.__pool.semaphore(host):
+            # aiohttp treats a timeout of zero as none, hence the remaining time is checked once per attempt
+            attempt_timeout = request_timeout(timeout)
+            if attempt_timeout <= 0 and budget_exhausted():
+                LOG.info("Skipped query %s on host %s, the collection ran out of time", query, host)
+                return None
+            start = time.perf_counter()
+            status, body = await self.__get(host, url, token, attempt_timeout, labels)
+
+            # token is invalid, request a new token
+            if status == 403 and (b"Token was invalid" in body or b"token" in body):
+                QUERY_TOKEN_RETRIES.labels(*labels).inc()
+                token = await self.__pool.refreshCookie(host, token)
+                if token is None:
+                    self.__pool.set_session_unavailable(host)
+                    return None
+                attempt_timeout = request_timeout(timeout)
+                if attempt_timeout <= 0 and budget_exhausted():
+                    LOG.info("Skipped retrying query %s on host %s, the collection ran out of time", query, host)
+                    return None
+                status, body = await self.__get(host, url, token, attempt_timeout, labels)
+
+        if status is None:
+            return None
+        QUERY_DURATION.labels(*labels).observe(time.perf_counter() - start)
+        self.__selector.observe_result(host, status < 500)
+        if status == 200:
+            start = time.perf_counter()
+            res = JsonDecoder.loads(body)
+            observe_response(self.__collector, host, query, len(body), len(res.get('imdata', [])),
+                             time.perf_counter() - start)
+            return res
+        else:
+            LOG.error("url %s responding with %s", url, status)
+            return None
+
+    async def __get(self, host: str, url: str, token: str, timeout: int, labels: tuple) -> Tuple[int, bytes]:
+        """Returns status and body of the GET request or (None, None) if the host did not respond"""
+        try:
+            LOG.debug('Submitting request %s', url)
+            async with self.__pool.session.get(url, headers={'Cookie': 'APIC-cookie=' + token},
+                                               trace_request_ctx=host,
+                                               timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                return resp.status, decompress(host, await resp.read(), resp.headers.get('Content-Encoding'))
+        except asyncio.TimeoutError:
+            if budget_exhausted():
+                # the request was cut short by the deadline of the collection, not by the host
+                LOG.warning("Request %s was cancelled, the collection ran out of time", url)
+                return None, None
+            LOG.error("Connection with host %s timed out after %s sec", host,
+                      timeout)
+            QUERY_TIMEOUTS.labels(*labels).inc()
+        except (aiohttp.ClientError, ConnectionError) as e:
+            LOG.error("Cannot connect to %s: %s", url, e)
+        self.__selector.observe_result(host, False)
+        self.__pool.set_session_unavailable(host)
+        return None, None
+
+    def get_unresponsive_hosts(self) -> List[str]:
+        """Returns the hosts whose circuit is not closed."""
+        return self.__pool.get_unavailable_sessions()
+
+    def isDataValid(self, data: Dict):
+        """Checks if the data is a dict that contains 'imdata'."""
+        if data is None:
+            return False
+        if isinstance(data, dict) and isinstance(data.get('imdata'), list):
+            return True
+        return False
@@ -0,0 +1,97 @@
+import logging
+import random
+import threading
+import time
+
+from modules.PerFabric import per_fabric
+from prometheus_client.core import Counter, Gauge
+from typing import Dict, List
+
+LOG = logging.getLogger('apic_exporter.exporter')
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+STATE_NAMES = {CLOSED: 'closed', HALF_OPEN: 'half-open', OPEN: 'open'}
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+CIRCUIT_STATE = Gauge('apic_exporter_circuit_state',
+                      'State of the circuit breaker of the APIC host, 0 closed, 1 half-open and 2 open',
+                      ['apicHost'])
+CIRCUIT_OPENS = Counter('apic_exporter_circuit_opens',
+                        'Times the circuit breaker of the APIC host opened after a failure',
+                        ['apicHost'])
+
+
+class Circuit(object):
+    def __init__(self):
+        """State of the circuit of a host. opened counts the consecutive openings without a successful
+           trial in between, retry_at is when the open circuit lets the next trial through"""
+        self.state = CLOSED
+        self.opened = 0
+        self.retry_at = 0.0
+
+
+@per_fabric
+class CircuitBreakers(object):
+    def __init__(self, hosts: List[str], base: float = BACKOFF_BASE, maximum: float = BACKOFF_MAX):
+        """A circuit breaker per APIC host, shared by the sessions of the fabric. A failure opens the circuit
+           and queries skip the host right away. Once the backoff elapsed, the circuit is half-open and a
+           single login is tried in the background, which closes the circuit or opens it again. The backoff
+           doubles with every consecutive opening from base up to maximum seconds, with jitter so the
+           exporters do not retry in lockstep."""
+        self.__base = base
+        self.__maximum = maximum
+        self.__circuits: Dict[str, Circuit] = {host: Circuit() for host in hosts}
+        self.__lock = threading.Lock()
+        for host in hosts:
+            CIRCUIT_STATE.labels(host).set(CLOSED)
+
+    def allows(self, host: str) -> bool:
+        """Whether queries may be sent to the host"""
+        circuit = self.__circuits.get(host)
+        return circuit is None or circuit.state == CLOSED
+
+    def trial_due(self, host: str) -> bool:
+        """Whether the backoff of the open circuit elapsed. Turns the circuit half-open, hence the caller
+           is the only one to try the host and has to record the result"""
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            if circuit is None or circuit.state != OPEN or circuit.retry_at > time.monotonic():
+                return False
+            self.__set_state(host, circuit, HALF_OPEN)
+            return True
+
+    def next_trial(self) -> float:
+        """The monotonic time the next open circuit becomes due for a trial, None if none is open"""
+        with self.__lock:
+            return min((circuit.retry_at for circuit in self.__circuits.values() if circuit.state == OPEN),
+                       default=None)
+
+    def record_success(self, host: str):
+        """Closes the circuit of the host"""
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return
+            LOG.info("Apic host %s is available again", host)
+            circuit.opened = 0
+            self.__set_state(host, circuit, CLOSED)
+
+    def record_failure(self, host: str):
+        """Opens the circuit of the host, or keeps it open if a concurrent failure already opened it"""
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            if circuit is None or circuit.state == OPEN:
+                return
+            backoff = min(self.__base * 2 ** circuit.opened, self.__maximum)
+            backoff *= random.uniform(0.5, 1.0)
+            circuit.opened += 1
+            circuit.retry_at = time.monotonic() + backoff
+            LOG.warning("Apic host %s is unavailable, retrying in %.1f sec", host, backoff)
+            self.__set_state(host, circuit, OPEN)
+            CIRCUIT_OPENS.labels(host).inc()
+
+    def __set_state(self, host: str, circuit: Circuit, state: int):
+        LOG.debug("Circuit of host %s is %s", host, STATE_NAMES[state])
+        circuit.state = state
+        CIRCUIT_STATE.labels(host).set(state)
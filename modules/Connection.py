@@ -1,107 +1,152 @@
 import requests
 from requests import cookies
+import contextvars
 import logging
-import json
+import threading
+import time
 
 from urllib3 import disable_warnings
 from urllib3 import exceptions
-from singleton_decorator import singleton
-
-from typing import List, Dict
+from modules import JsonDecoder
+from modules.PerFabric import per_fabric
+from prometheus_client.core import Counter, Gauge
+from modules.JsonStream import ImdataStream
+from modules.SingleFlight import SingleFlight
+from modules.HostSelector import HostSelector
+from modules.CircuitBreaker import CircuitBreakers
+from modules.Deadline import budget_exhausted, request_timeout
+from modules.Transport import CONNECTION_POOL_SIZE, APICAdapter, IncompleteResponse, accept_encoding, \
+    observe_transfer
+from modules.Instrumentation import QUERY_DURATION, QUERY_TIMEOUTS, QUERY_TOKEN_RETRIES, \
+    observe_response, query_class
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterator, Tuple
 from collections import namedtuple
 
 LOG = logging.getLogger('apic_exporter.exporter')
 TIMEOUT = 10
 COOKIE_TIMEOUT = 5
+PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+TOKEN_LIFETIME = 600
+TOKEN_REFRESH_RATIO = 0.5
+MAX_REFRESH_SLEEP = 60
+PROBE_QUERY = '/api/node/class/topSystem.json?query-target-filter=eq(topSystem.role,"controller")'
 session_tuple = namedtuple('session_tuple', 'session available')
-
-
-@singleton
+COALESCED_REQUESTS = Counter('apic_exporter_coalesced_requests',
+                             'APIC requests answered by an identical request already in flight',
+                             ['apicHost'])
+REQUESTS_IN_FLIGHT = SingleFlight()
+SESSION_AGE = Gauge('apic_exporter_session_age_seconds',
+                    'Time since the APIC token of the session was issued or refreshed',
+                    ['apicHost', 'transport'])
+TOKEN_REFRESHES = Counter('apic_exporter_token_refreshes',
+                          'APIC tokens renewed in the background ahead of their expiry',
+                          ['apicHost', 'transport'])
+TOKEN_REFRESH_FAILURES = Counter('apic_exporter_token_refresh_failures',
+                                 'Background renewals of APIC tokens that failed',
+                                 ['apicHost', 'transport'])
+
+
+@per_fabric
 class SessionPool(object):
-    def __init__(self, hosts, user, password):
-        """Initializes the Session Pool. Sessions contains the session to a host and an Availability flag"""
+    def __init__(self, hosts, user, password, pool_size=CONNECTION_POOL_SIZE, compression=True):
+        """Initializes the Session Pool. Sessions contains the session to a host and whether it is logged in.
+           Each session keeps up to pool_size connections alive and asks for gzip compressed responses
+           if compression is set. Failing hosts are skipped by their circuit breakers and logged into
+           again in the background."""
         self.__sessions = {}
         self.__user = user
         self.__password = password
-        self.__unavailable_sessions = 0
+        self.__pool_size = pool_size
+        self.__compression = compression
+        self.__breakers = CircuitBreakers(hosts)
+        self.__lock = threading.RLock()
+        self.__issued: Dict[str, float] = {}
+        self.__refresh_at: Dict[str, float] = {}
 
         for host in hosts:
             self.__sessions[host] = self.createSession(host)
 
+        thread = threading.Thread(target=self.__refresh_loop, name='token-refresh', daemon=True)
+        thread.start()
+
     def getSession(self, host: str) -> session_tuple:
-        """Returns the session and availability"""
-        if self.__unavailable_sessions == len(self.__sessions):
-            self.reset_unavailable_hosts()
-        return self.__sessions[host]
+        """Returns the session and availability. A host is available while its circuit is closed. A session
+           that is not logged in although the circuit is closed, because a login of the asyncio transport
+           closed it, logs in first."""
+        with self.__lock:
+            session, logged_in = self.__sessions[host]
+        if not self.__breakers.allows(host):
+            return session_tuple(session, False)
+        if not logged_in:
+            session = self.refreshCookie(host)
+            with self.__lock:
+                logged_in = self.__sessions[host].available
+        return session_tuple(session, logged_in and self.__breakers.allows(host))
 
     def createSession(self, host: str) -> session_tuple:
         """Creates the session and requests the cookie."""
         session = requests.Session()
         session.proxies = {'https': '', 'http': '', 'no': '*'}
         session.verify = False
+        session.headers['Accept-Encoding'] = accept_encoding(self.__compression)
+        session.mount('https://', APICAdapter(host, self.__pool_size))
 
         cookie = self.requestCookie(host, session)
         if cookie is not None:
             session.cookies = cookies.cookiejar_from_dict(
                 cookie_dict={"APIC-cookie": cookie})
+        else:
+            self.__breakers.record_failure(host)
 
-        available = True if session is not None and cookie is not None else False
-        if not available:
-            self.__unavailable_sessions += 1
-        return session_tuple(session, available)
-
-    def reset_unavailable_hosts(self):
-        """Reset availability of all sessions and try to repair unavailable sessions."""
-        unavailable = 0
-        for host, value in self.__sessions.items():
-            if value.session is None:
-                self.__sessions[host] = self.createSession(host)
-                continue
-
-            if len(value.session.cookies) == 0:
-                cookie = self.requestCookie(host, value.session)
-                if cookie is not None:
-                    value.session.cookies = cookies.cookiejar_from_dict(
-                        cookie_dict={"APIC-cookie": cookie})
-                    self.__sessions[host] = session_tuple(value.session, True)
-                else:
-                    self.__sessions[host] = session_tuple(value.session, False)
-                    unavailable += 1
-            else:
-                self.__sessions[host] = session_tuple(value.session, True)
-        self.__unavailable_sessions = unavailable
+        return session_tuple(session, cookie is not None)
 
     def get_unavailable_sessions(self) -> List[str]:
-        return [k for k, v in self.__sessions.items() if not v.available]
+        return [host for host in self.__sessions if not self.__breakers.allows(host)]
+
+    def repair_host(self, host: str) -> bool:
+        """Tries to log into the host again if the backoff of its open circuit elapsed.
+           Returns whether the host is available."""
+        if self.__breakers.trial_due(host):
+            self.__renew(host)
+        return self.getSession(host).available
 
     def set_session_unavailable(self, host: str):
-        """Set a given host to be unavailable. Resets hosts, if all are unavailable"""
+        """Opens the circuit of a host that failed to respond, queries skip it until a background login
+           succeeds"""
         if host in self.__sessions:
             LOG.debug("Flag host %s as unavailable", host)
-            session, _ = self.__sessions[host]
-            self.__sessions[host] = session_tuple(session, False)
-            self.__unavailable_sessions += 1
-        if self.__unavailable_sessions == len(self.__sessions):
-            self.reset_unavailable_hosts()
+            self.__breakers.record_failure(host)
 
     def refreshCookie(self, host: str) -> requests.Session:
-        """Clears old cookie and requests a fresh one"""
-        session, available = self.__sessions[host]
-
-        cookie = self.requestCookie(host, session)
-
-        if cookie is not None:
-            session.cookies.clear_session_cookies()
-            session.cookies = cookies.cookiejar_from_dict(
-                cookie_dict={"APIC-cookie": cookie}, cookiejar=session.cookies)
-            available = True
-        else:
-            available = False
-
-        self.__sessions[host] = session_tuple(session, available)
-        return session
+        """Clears old cookie and requests a fresh one. The login runs outside the pool's lock, hence it does
+           not hold up the queries to the other hosts. It is capped by the budget of the collection and
+           keeps the old cookie if the budget runs out."""
+        with self.__lock:
+            session, _ = self.__sessions[host]
 
-    def requestCookie(self, host: str, session: requests.Session) -> str:
+        timeout = request_timeout(COOKIE_TIMEOUT)
+        if timeout <= 0 and budget_exhausted():
+            return session
+        cookie = self.requestCookie(host, session, timeout)
+        if cookie is None and budget_exhausted():
+            # the login was cut short by the deadline of the collection, not by the host
+            LOG.warning("Login to %s was cancelled, the collection ran out of time", host)
+            return session
+        if cookie is None:
+            self.__breakers.record_failure(host)
+
+        with self.__lock:
+            if cookie is not None:
+                session.cookies.clear_session_cookies()
+                session.cookies = cookies.cookiejar_from_dict(
+                    cookie_dict={"APIC-cookie": cookie}, cookiejar=session.cookies)
+            self.__sessions[host] = session_tuple(session, cookie is not None)
+            return session
+
+    def requestCookie(self, host: str, session: requests.Session, timeout: float = COOKIE_TIMEOUT) -> str:
         """Login to the host and retrieve cookie"""
         disable_warnings(exceptions.InsecureRequestWarning)
 
@@ -117,11 +162,13 @@ class SessionPool(object):
                     }
                 }
             }
-            resp = session.post(url, json=payload, timeout=COOKIE_TIMEOUT)
+            resp = session.post(url, json=payload, timeout=timeout)
         except (requests.exceptions.ConnectTimeout,
                 requests.exceptions.ReadTimeout, TimeoutError):
+            if budget_exhausted():
+                return None
             LOG.error("Connection with host %s timed out after %s sec", host,
-                      COOKIE_TIMEOUT)
+                      timeout)
             return None
         except (requests.exceptions.ConnectionError, ConnectionError) as e:
             LOG.error("Cannot connect to %s: %s", url, e)
@@ -129,24 +176,169 @@ class SessionPool(object):
 
         cookie = None
         if resp.status_code == 200:
-            res = json.loads(resp.text)
+            res = JsonDecoder.loads(resp.content)
             resp.close()
             cookie = res['imdata'][0]['aaaLogin']['attributes']['token']
+            self.__token_issued(host, res['imdata'][0]['aaaLogin']['attributes'])
         else:
             LOG.error("url %s responds with %s", url, resp.status_code)
+            resp.close()
 
         return cookie
 
+    def refreshToken(self, host: str, session: requests.Session) -> str:
+        """Extend the session's token with aaaRefresh and retrieve the renewed cookie"""
+        url = "https://" + host + "/api/aaaRefresh.json"
+        try:
+            resp = session.get(url, timeout=COOKIE_TIMEOUT)
+        except (requests.exceptions.ConnectTimeout,
+                requests.exceptions.ReadTimeout, TimeoutError):
+            LOG.error("Connection with host %s timed out after %s sec", host,
+                      COOKIE_TIMEOUT)
+            return None
+        except (requests.exceptions.ConnectionError, ConnectionError) as e:
+            LOG.error("Cannot connect to %s: %s", url, e)
+            return None
+
+        if resp.status_code != 200:
+            LOG.error("url %s responds with %s", url, resp.status_code)
+            resp.close()
+            return None
+        res = JsonDecoder.loads(resp.content)
+        resp.close()
+        self.__token_issued(host, res['imdata'][0]['aaaLogin']['attributes'])
+        return res['imdata'][0]['aaaLogin']['attributes']['token']
+
+    def __token_issued(self, host: str, attributes: Dict):
+        """Schedule the renewal of a new token ahead of its refresh timeout"""
+        now = time.monotonic()
+        lifetime = int(attributes.get('refreshTimeoutSeconds', TOKEN_LIFETIME))
+        self.__issued[host] = now
+        self.__refresh_at[host] = now + lifetime * TOKEN_REFRESH_RATIO
+        SESSION_AGE.labels(host, 'sync').set_function(lambda: time.monotonic() - self.__issued[host])
+
+    def __refresh_loop(self):
+        """Renews the tokens ahead of their expiry and tries hosts with an open circuit once their backoff
+           elapsed, so scrapes do not wait for authentication"""
+        while True:
+            now = time.monotonic()
+            # renewals of the other hosts may add to the schedule meanwhile
+            wakeups = [at for host, at in list(self.__refresh_at.items()) if self.__breakers.allows(host)]
+            next_trial = self.__breakers.next_trial()
+            if next_trial is not None:
+                wakeups.append(next_trial)
+            next_refresh = min(wakeups, default=now + MAX_REFRESH_SLEEP)
+            time.sleep(min(max(next_refresh - now, 1), MAX_REFRESH_SLEEP))
+            for host in list(self.__sessions):
+                if self.__breakers.trial_due(host) or (self.__breakers.allows(host) and
+                                                       self.__refresh_at.get(host, 0) <= time.monotonic()):
+                    self.__renew(host)
+
+    def __renew(self, host: str):
+        """Refreshes the host and records any error as a failure, which also ends a trial of its circuit"""
+        try:
+            self.__refresh(host)
+        except Exception as e:
+            LOG.error("Renewing the session of %s failed: %s", host, e)
+            self.__breakers.record_failure(host)
+
+    def __refresh(self, host: str):
+        """Renews the token of the host or logs in again and records the outcome in the host's circuit"""
+        session, _ = self.__sessions[host]
+        cookie = None
+        if len(session.cookies) > 0:
+            cookie = self.refreshToken(host, session)
+            if cookie is None:
+                TOKEN_REFRESH_FAILURES.labels(host, 'sync').inc()
+            else:
+                TOKEN_REFRESHES.labels(host, 'sync').inc()
+        if cookie is None:
+            cookie = self.requestCookie(host, session)
+        if cookie is None:
+            self.__breakers.record_failure(host)
+            return
+
+        with self.__lock:
+            session, _ = self.__sessions[host]
+            session.cookies = cookies.cookiejar_from_dict(cookie_dict={"APIC-cookie": cookie})
+            self.__sessions[host] = session_tuple(session, True)
+        self.__breakers.record_success(host)
+
 
 class Connection():
-    def __init__(self, hosts: List[str], user: str, password: str):
-        self.__pool = SessionPool(hosts, user, password)
+    def __init__(self, hosts: List[str], user: str, password: str, collector: str = '',
+                 pool_size: int = CONNECTION_POOL_SIZE, compression: bool = True):
+        """collector is the name the queries of this connection are instrumented with"""
+        self.__pool = SessionPool(hosts, user, password, pool_size, compression)
+        self.__selector = HostSelector(hosts)
+        self.__collector = collector
+
+    @property
+    def selector(self) -> HostSelector:
+        return self.__selector
 
     def getRequest(self, host: str, query: str, timeout: int = TIMEOUT) -> Dict:
-        """Perform a GET request against host for the query. Retries if token is invalid."""
+        """Perform a GET request against host for the query. Retries if token is invalid.
+           Concurrent identical requests to the same host share one request and its decoded result, unless
+           the shared request ran out of the budget of the collection that issued it."""
+        (res, out_of_time), shared = REQUESTS_IN_FLIGHT.do((host, query), self.__flight, host, query, timeout)
+        if not shared:
+            return res
+        if out_of_time:
+            # the shared request ran out of the budget of the collection that issued it, not of this one
+            return self.__getRequest(host, query, timeout)
+        COALESCED_REQUESTS.labels(host).inc()
+        return res
+
+    def __flight(self, host: str, query: str, timeout: int) -> Tuple[Dict, bool]:
+        """Returns the result and whether the request was skipped or cut short by the budget"""
+        res = self.__getRequest(host, query, timeout)
+        return res, res is None and budget_exhausted()
+
+    def __getRequest(self, host: str, query: str, timeout: int) -> Dict:
+        resp = self.__submit(host, query, timeout)
+        if resp is None:
+            return None
+
+        start = time.perf_counter()
+        res = JsonDecoder.loads(resp.content)
+        decode_seconds = time.perf_counter() - start
+        resp.close()
+        observe_transfer(host, 'sync', resp.raw.tell(), len(resp.content))
+        observe_response(self.__collector, host, query, len(resp.content), len(res.get('imdata', [])),
+                         decode_seconds)
+        return res
+
+    def getRequestStream(self, host: str, query: str, timeout: int = TIMEOUT) -> Dict:
+        """Perform a streamed GET request against host for the query. Retries if token is invalid.
+           The returned imdata is an iterator decoding one object at a time from the socket."""
+        resp = self.__submit(host, query, timeout, stream=True)
+        if resp is None:
+            return None
+
+        def on_close():
+            resp.close()
+            observe_transfer(host, 'sync', resp.raw.tell(), stream.bytes_read)
+            observe_response(self.__collector, host, query, stream.bytes_read, stream.objects,
+                             stream.decode_seconds)
+
+        stream = ImdataStream(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE), on_close=on_close)
+        if not stream.read_header():
+            LOG.error("url %s did not return imdata", resp.url)
+            stream.close()
+            return None
+
+        res = {'imdata': stream}
+        if stream.total_count is not None:
+            res['totalCount'] = stream.total_count
+        return res
+
+    def __submit(self, host: str, query: str, timeout: int, stream: bool = False) -> requests.Response:
+        """Perform the GET request and return the successful response or None."""
         disable_warnings(exceptions.InsecureRequestWarning)
 
         url = "https://" + host + query
+        labels = (self.__collector, host, query_class(query))
 
         session, available = self.__pool.getSession(host)
 
@@ -154,59 +346,106 @@ class Connection():
             LOG.info("Skipped unavailable host %s query %s", host, query)
             return None
 
-        try:
-            LOG.debug('Submitting request %s', url)
-            resp = session.get(url, timeout=timeout)
-        except (requests.exceptions.ConnectTimeout,
-                requests.exceptions.ReadTimeout, TimeoutError):
-            LOG.error("Connection with host %s timed out after %s sec", host,
-                      timeout)
-            self.__pool.set_session_unavailable(host)
+        timeout = request_timeout(timeout)
+        if timeout <= 0 and budget_exhausted():
+            LOG.info("Skipped query %s on host %s, the collection ran out of time", query, host)
             return None
-        except (requests.exceptions.ConnectionError, ConnectionError) as e:
-            LOG.error("Cannot connect to %s: %s", url, e)
-            self.__pool.set_session_unavailable(host)
+
+        start = time.perf_counter()
+        resp = self.__get(session, host, url, timeout, stream, labels)
+        if resp is None:
             return None
 
         # token is invalid, request a new token
         if resp.status_code == 403 and ("Token was invalid" in resp.text
                                         or "token" in resp.text):
+            QUERY_TOKEN_RETRIES.labels(*labels).inc()
 
             session = self.__pool.refreshCookie(host)
 
-            try:
-                resp = session.get(url, timeout=timeout)
-            except (requests.exceptions.ConnectTimeout,
-                    requests.exceptions.ReadTimeout, TimeoutError):
-                LOG.error("Connection with host %s timed out after %s sec",
-                          host, timeout)
-                self.__pool.set_session_unavailable(host)
+            timeout = request_timeout(timeout)
+            if timeout <= 0 and budget_exhausted():
+                LOG.info("Skipped retrying query %s on host %s, the collection ran out of time", query, host)
                 return None
-            except (requests.exceptions.ConnectionError, ConnectionError) as e:
-                LOG.error("Cannot connect to %s: %s", url, e)
-                self.__pool.set_session_unavailable(host)
+            resp = self.__get(session, host, url, timeout, stream, labels)
+            if resp is None:
                 return None
+        QUERY_DURATION.labels(*labels).observe(time.perf_counter() - start)
+        self.__selector.observe_result(host, resp.status_code < 500)
 
         if resp.status_code == 200:
-            res = json.loads(resp.text)
-            resp.close()
-            return res
+            return resp
         else:
             LOG.error("url %s responding with %s", url, resp.status_code)
+            resp.close()
             return None
 
+    def __get(self, session: requests.Session, host: str, url: str, timeout: int, stream: bool,
+              labels: tuple) -> requests.Response:
+        """Returns the response or None if the host did not respond."""
+        try:
+            LOG.debug('Submitting request %s', url)
+            return session.get(url, timeout=timeout, stream=stream)
+        except (requests.exceptions.ConnectTimeout,
+                requests.exceptions.ReadTimeout, TimeoutError):
+            if budget_exhausted():
+                # the request was cut short by the deadline of the collection, not by the host
+                LOG.warning("Request %s was cancelled, the collection ran out of time", url)
+                return None
+            LOG.error("Connection with host %s timed out after %s sec", host,
+                      timeout)
+            QUERY_TIMEOUTS.labels(*labels).inc()
+        except (requests.exceptions.ConnectionError, ConnectionError) as e:
+            LOG.error("Cannot connect to %s: %s", url, e)
+        self.__selector.observe_result(host, False)
+        self.__pool.set_session_unavailable(host)
+        return None
+
+    def probe(self, host: str):
+        """Measure the response time of the host with a small query. A host with an open circuit is tried
+           first once its backoff elapsed, hence a recovered host becomes available again right away"""
+        if not self.__pool.repair_host(host):
+            self.__selector.observe_result(host, False)
+            return
+        start = time.perf_counter()
+        if self.isDataValid(self.__getRequest(host, PROBE_QUERY, COOKIE_TIMEOUT)):
+            self.__selector.observe_latency(host, time.perf_counter() - start)
+
+    def getPages(self, host: str, query: str, page_size: int = PAGE_SIZE, timeout: int = TIMEOUT) -> Iterator[Dict]:
+        """Perform the GET request page by page using the APIC page and page-size options.
+           The next page is already requested while the current one is processed.
+           Stops at the first page that is invalid. If it is not the first page, IncompleteResponse is raised,
+           since the caller already processed a part of the pages."""
+        separator = '&' if '?' in query else '?'
+        page_query = query + separator + 'page-size=' + str(page_size) + '&page='
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='page') as executor:
+            page = 0
+            # pages are requested within the deadline of the calling collection
+            future = executor.submit(contextvars.copy_context().run, self.getRequest, host,
+                                     page_query + str(page), timeout)
+            while future is not None:
+                data = future.result()
+                if not self.isDataValid(data):
+                    LOG.error("Apic host %s did not return page %s of %s", host, page, query)
+                    if page > 0:
+                        raise IncompleteResponse("apic host %s did not return page %s of %s" % (host, page, query))
+                    return
+                page += 1
+                future = None
+                if page * page_size < int(data.get('totalCount', 0)):
+                    future = executor.submit(contextvars.copy_context().run, self.getRequest, host,
+                                             page_query + str(page), timeout)
+                yield data
+
     def get_unresponsive_hosts(self) -> List[str]:
-        """Returns a list of hosts that were not responding since the last reset."""
+        """Returns the hosts whose circuit is not closed."""
         return self.__pool.get_unavailable_sessions()
 
-    def reset_unavailable_hosts(self):
-        """Unavailable hosts are repaired and the flags are reset"""
-        self.__pool.reset_unavailable_hosts()
-
     def isDataValid(self, data: Dict):
         """Checks if the data is a dict that contains 'imdata'."""
         if data is None:
             return False
-        if isinstance(data, dict) and isinstance(data.get('imdata'), list):
+        if isinstance(data, dict) and isinstance(data.get('imdata'), (list, ImdataStream)):
             return True
         return False
@@ -0,0 +1,110 @@
+import contextvars
+import logging
+import threading
+import time
+
+from prometheus_client.core import GaugeMetricFamily
+from modules.Outcome import mark_incomplete
+from typing import Dict, List, Tuple
+
+LOG = logging.getLogger('apic_exporter.exporter')
+
+
+class Budget(object):
+    def __init__(self, seconds: float):
+        """Time left for a collection. Exhausted is set once a request was skipped or cut short because the
+           budget ran out, hence the collection is partial."""
+        self.deadline = time.monotonic() + seconds
+        self.exhausted = False
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+
+BUDGET: contextvars.ContextVar = contextvars.ContextVar('apic_exporter_budget', default=None)
+
+
+def request_timeout(timeout: float) -> float:
+    """The timeout of a request, capped by the budget of the current collection. Zero or less if the
+       budget is exhausted."""
+    budget = BUDGET.get()
+    if budget is None:
+        return timeout
+    return min(timeout, budget.remaining())
+
+
+def budget_exhausted() -> bool:
+    """Whether the budget of the current collection ran out, which marks the collection partial"""
+    budget = BUDGET.get()
+    if budget is None or budget.remaining() > 0:
+        return False
+    budget.exhausted = True
+    return True
+
+
+def carry_budget(coro):
+    """Wraps a coroutine that runs on another thread's event loop into one running within the budget of the
+       calling thread"""
+    budget = BUDGET.get()
+
+    async def run():
+        BUDGET.set(budget)
+        return await coro
+    return run()
+
+
+class DeadlineStatus(object):
+    def __init__(self, labels: List[str] = None):
+        """Whether the last collection of each collector with a deadline ran out of it. A single status is
+           registered with the exporter's registry and fed by the DeadlineCollectors, hence the family is
+           described and served once for all of them. labels name the values the collectors report under."""
+        self.__labels = list(labels or ['collector'])
+        self.__partial: Dict[Tuple[str, ...], bool] = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], partial: bool):
+        with self.__lock:
+            self.__partial[labels] = partial
+
+    def describe(self):
+        yield GaugeMetricFamily('apic_exporter_collector_partial',
+                                'Collector ran out of its deadline and its metrics are incomplete')
+
+    def collect(self):
+        g_partial = GaugeMetricFamily('apic_exporter_collector_partial',
+                                      'Collector ran out of its deadline and its metrics are incomplete',
+                                      labels=self.__labels)
+        with self.__lock:
+            for labels, partial in sorted(self.__partial.items()):
+                g_partial.add_metric(labels=list(labels), value=1 if partial else 0)
+        yield g_partial
+
+
+class DeadlineCollector(object):
+    def __init__(self, name: str, collector, deadline: float, status: DeadlineStatus,
+                 labels: Tuple[str, ...] = None):
+        """Runs the collector within a budget of deadline seconds. Requests of the collector are cut short or
+           skipped once the budget is exhausted and the collector yields what it finished. Whether that was
+           the case is reported to status under labels, the collector's name by default."""
+        self.name = name
+        self.deadline = deadline
+        self.__collector = collector
+        self.__status = status
+        self.__labels = labels or (name,)
+
+    def describe(self):
+        yield from self.__collector.describe()
+
+    def collect(self):
+        budget = Budget(self.deadline)
+        token = BUDGET.set(budget)
+        try:
+            metrics = list(self.__collector.collect())
+        finally:
+            BUDGET.reset(token)
+        if budget.exhausted:
+            LOG.warning("Collector %s exceeded its deadline of %s sec, its metrics are partial",
+                        self.name, self.deadline)
+            mark_incomplete("deadline of %s sec exceeded" % self.deadline)
+        self.__status.observe(self.__labels, budget.exhausted)
+        yield from metrics
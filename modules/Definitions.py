@@ -0,0 +1,161 @@
+import logging
+import re
+import yaml
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.metrics_core import Metric
+from modules.Topology import fabric_node
+
+from typing import Callable, Dict, Iterator, List, Tuple
+
+LOG = logging.getLogger('apic_exporter.exporter')
+NODE_ID = re.compile(r'topology/pod-[0-9]+/node-([0-9]+)')
+NODE_FIELDS = fabric_node._fields
+METRIC_TYPES = {'gauge': GaugeMetricFamily, 'counter': CounterMetricFamily}
+
+# extractors are called with the host, the attributes of the object, the attributes of the joined children
+# by alias and the fabric node of the object
+Extractor = Callable[[str, Dict, Dict[str, Dict], fabric_node], str]
+
+
+class DefinitionError(Exception):
+    pass
+
+
+def load_definitions(path: str) -> List[Dict]:
+    """Reads the list of metric definitions from a yaml file"""
+    with open(path) as f:
+        definitions = yaml.load(f, Loader=yaml.SafeLoader)
+    if not isinstance(definitions, list):
+        raise DefinitionError("%s does not contain a list of definitions" % path)
+    return definitions
+
+
+def compile_source(source, aliases: List[str]) -> Extractor:
+    """Compiles a label or value source into an extractor. A source is 'host', 'node.<field>' of the fabric
+       node, '<alias>.<attribute>' of a joined child or an attribute of the object. Given as mapping with
+       'from' and 'regex' the first group of the regex applied to the source is extracted."""
+    if isinstance(source, dict):
+        if 'from' not in source or 'regex' not in source:
+            raise DefinitionError("Source %s needs 'from' and 'regex'" % source)
+        extract = compile_source(source['from'], aliases)
+        regex = re.compile(source['regex'])
+
+        def extract_match(host, attributes, joined, node):
+            value = extract(host, attributes, joined, node)
+            match = regex.search(value) if value is not None else None
+            return match.group(1) if match else None
+        return extract_match
+
+    if source == 'host':
+        return lambda host, attributes, joined, node: host
+    prefix, _, name = source.partition('.')
+    if prefix == 'node' and name:
+        if name not in NODE_FIELDS:
+            raise DefinitionError("Unknown node field %s, expected one of %s" % (name, ', '.join(NODE_FIELDS)))
+        index = NODE_FIELDS.index(name)
+        return lambda host, attributes, joined, node: node[index]
+    if prefix in aliases and name:
+        return lambda host, attributes, joined, node: joined[prefix].get(name)
+    return lambda host, attributes, joined, node: attributes.get(source)
+
+
+def uses_node(source) -> bool:
+    if isinstance(source, dict):
+        return uses_node(source.get('from'))
+    return isinstance(source, str) and source.startswith('node.')
+
+
+class MetricDefinition(object):
+    def __init__(self, definition: Dict):
+        """A metric definition compiled into extractors. See README for the format"""
+        try:
+            self.name: str = definition['name']
+            self.mo_class: str = definition['class']
+            self.query: str = definition['query']
+            metrics = definition['metrics']
+        except KeyError as e:
+            raise DefinitionError("Definition %s misses %s" % (definition.get('name', definition), e))
+        self.node_query: str = definition.get('node_query')
+        self.node_role: str = definition.get('node_role')
+
+        # joined children by alias with the class and the attributes they have to match
+        self.__joins: List[Tuple[str, str, Dict[str, str]]] = []
+        for alias, join in (definition.get('join') or {}).items():
+            match = {k: str(v) for k, v in (join.get('match') or {}).items()}
+            self.__joins.append((alias, join['class'], match))
+        aliases = [alias for alias, _, _ in self.__joins]
+
+        labels: Dict = definition.get('labels') or {}
+        self.label_names: List[str] = list(labels)
+        self.__labels: List[Extractor] = [compile_source(source, aliases) for source in labels.values()]
+        self.metrics: List[Tuple[str, str, str]] = []
+        self.__values: List[Extractor] = []
+        for metric in metrics:
+            metric_type = metric.get('type', 'gauge')
+            if metric_type not in METRIC_TYPES:
+                raise DefinitionError("Metric %s has unknown type %s" % (metric['name'], metric_type))
+            self.metrics.append((metric['name'], metric.get('help', metric['name']), metric_type))
+            self.__values.append(compile_source(metric['value'], aliases))
+
+        sources = list(labels.values()) + [metric['value'] for metric in metrics]
+        self.needs_nodes = self.node_role is not None or self.node_query is not None or \
+            any(uses_node(source) for source in sources)
+
+    def create_metrics(self) -> List[Metric]:
+        return [METRIC_TYPES[metric_type](name, documentation, labels=self.label_names)
+                for name, documentation, metric_type in self.metrics]
+
+    def describe(self) -> Iterator[Metric]:
+        for name, documentation, metric_type in self.metrics:
+            yield METRIC_TYPES[metric_type](name, documentation)
+
+    def queries(self, nodes: List[fabric_node], node_mode: bool) -> List[str]:
+        """The query of the definition, or one query per fabric node in node mode"""
+        if node_mode and self.node_query is not None:
+            return [self.node_query.replace('{node.dn}', node.dn) for node in nodes
+                    if self.node_role is None or node.role == self.node_role]
+        return [self.query]
+
+    def extract(self, host: str, imdata: List[Dict], nodes: Dict[str, fabric_node],
+                metrics: List[Metric]) -> int:
+        """Adds a sample per object of the class to each of the metrics. Objects without all joined children
+           or, if nodes are used, without a matching fabric node are skipped. Returns the number of samples"""
+        samples = 0
+        for item in imdata:
+            mo = item.get(self.mo_class)
+            if mo is None:
+                continue
+            attributes = mo['attributes']
+
+            node = None
+            if self.needs_nodes:
+                match = NODE_ID.match(attributes.get('dn', ''))
+                node = nodes.get(match.group(1)) if match else None
+                if node is None or self.node_role is not None and node.role != self.node_role:
+                    continue
+
+            joined = self.__join(mo.get('children', ()))
+            if joined is None:
+                continue
+
+            labels = [extract(host, attributes, joined, node) or '' for extract in self.__labels]
+            for metric, extract in zip(metrics, self.__values):
+                value = extract(host, attributes, joined, node)
+                if value is not None:
+                    metric.add_metric(labels, float(value))
+                    samples += 1
+        return samples
+
+    def __join(self, children: List[Dict]) -> Dict[str, Dict]:
+        """Returns the attributes of the first child per join, None if a join has no matching child"""
+        joined = {}
+        for alias, mo_class, match in self.__joins:
+            for child in children:
+                child_mo = child.get(mo_class)
+                if child_mo is not None and all(child_mo['attributes'].get(k) == v for k, v in match.items()):
+                    joined[alias] = child_mo['attributes']
+                    break
+            else:
+                return None
+        return joined
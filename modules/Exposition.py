@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import logging
+import threading
+
+from wsgiref.simple_server import make_server
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.core import Counter
+from prometheus_client.exposition import ThreadingWSGIServer, choose_encoder
+from modules.Probe import SilentHandler
+
+from typing import Callable, Dict, Hashable
+
+LOG = logging.getLogger('apic_exporter.exporter')
+GZIP_LEVEL = 6
+MAX_FORMATS = 8
+OPENMETRICS_EOF = b'# EOF\n'
+EXPOSITION_RENDERS = Counter('apic_exporter_exposition_renders_total',
+                             'Renderings of the cached collector metrics by content type',
+                             ['format'])
+
+
+class RenderedPayload(object):
+    def __init__(self, body: bytes, content_type: str, version: Hashable):
+        """A version of the collected metrics rendered in one format, kept as is and gzip compressed"""
+        self.version = version
+        self.body = body
+        self.gzip = gzip.compress(body, GZIP_LEVEL)
+        self.digest = hashlib.sha1(content_type.encode('utf-8') + body).digest()
+
+
+class CachedExposition(object):
+    def __init__(self, collector, version: Callable[[], Hashable], registry: CollectorRegistry = REGISTRY):
+        """Renders the metrics of the collector once per version and format, together with the metrics of
+           the registry rendered on every request. version returns a value that changes whenever the
+           collector's metrics change."""
+        self.registry = registry
+        self.__collector = collector
+        self.__version = version
+        self.__payloads: Dict[str, RenderedPayload] = {}
+        self.__lock = threading.Lock()
+
+    def payload(self, encoder: Callable, content_type: str) -> RenderedPayload:
+        """The payload of the current version in the format of the content type, rendered if outdated.
+           OpenMetrics payloads lack the final EOF marker, which belongs to the registry's part."""
+        version = self.__version()
+        payload = self.__payloads.get(content_type)
+        if payload is not None and payload.version == version:
+            return payload
+        with self.__lock:
+            payload = self.__payloads.get(content_type)
+            if payload is None or payload.version != version:
+                body = encoder(self.__collector)
+                if body.endswith(OPENMETRICS_EOF):
+                    body = body[:-len(OPENMETRICS_EOF)]
+                payload = RenderedPayload(body, content_type, version)
+                if content_type in self.__payloads or len(self.__payloads) < MAX_FORMATS:
+                    self.__payloads[content_type] = payload
+                EXPOSITION_RENDERS.labels(content_type.split(';')[0]).inc()
+        return payload
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether the If-None-Match header lists the etag or is '*', comparing weakly as RFC 7232 requires"""
+    if not if_none_match:
+        return False
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def make_cached_app(exposition: CachedExposition):
+    """Serves the cached payload followed by the registry's metrics. Compressed responses concatenate the
+       cached gzip member with the compressed registry's metrics, which decompress as one stream.
+       The weak ETag identifies the cached payload: responses with the same collected metrics are equivalent
+       even though the exporter's own metrics, like the snapshot ages, advance in between."""
+
+    def app(environ, start_response):
+        encoder, content_type = choose_encoder(environ.get('HTTP_ACCEPT'))
+        gzipped = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+        payload = exposition.payload(encoder, content_type)
+
+        etag = 'W/"%s%s"' % (payload.digest.hex(), '-gzip' if gzipped else '')
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            start_response('304 Not Modified', [('ETag', etag)])
+            return [b'']
+
+        live = encoder(exposition.registry)
+        headers = [('Content-Type', content_type), ('ETag', etag)]
+        if gzipped:
+            body = [payload.gzip, gzip.compress(live, GZIP_LEVEL)]
+            headers.append(('Content-Encoding', 'gzip'))
+        else:
+            body = [payload.body, live]
+        headers.append(('Content-Length', str(sum(len(part) for part in body))))
+        start_response('200 OK', headers)
+        return body
+    return app
+
+
+def start_cached_server(port: int, exposition: CachedExposition, addr: str = '0.0.0.0'):
+    """Starts the metrics server for the cached exposition in a daemon thread"""
+    httpd = make_server(addr, port, make_cached_app(exposition), ThreadingWSGIServer, handler_class=SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from modules.PerFabric import per_fabric
+from prometheus_client.core import Gauge
+from typing import Callable, Dict, List
+
+LOG = logging.getLogger('apic_exporter.exporter')
+PROBE_INTERVAL = 30
+SMOOTHING = 0.3
+ERROR_THRESHOLD = 0.5
+HOST_LATENCY = Gauge('apic_exporter_host_latency_seconds',
+                     'Moving average of the APIC response time to the probe query',
+                     ['apicHost'])
+HOST_ERROR_RATE = Gauge('apic_exporter_host_error_rate',
+                        'Moving average of the share of failed requests to the APIC',
+                        ['apicHost'])
+
+
+class HostStats(object):
+    def __init__(self):
+        """Moving averages of the response time and the error rate of a host"""
+        self.latency: float = None
+        self.error_rate = 0.0
+        self.down = False
+
+
+@per_fabric
+class HostSelector(object):
+    def __init__(self, hosts: List[str]):
+        """Ranks the APIC hosts by their health and response time. The response time is measured by
+           periodic probes with the same small query on every host, hence hosts that currently get no
+           traffic are compared fairly and a recovered host earns traffic back"""
+        self.__hosts = list(hosts)
+        self.__stats: Dict[str, HostStats] = {host: HostStats() for host in hosts}
+        self.__lock = threading.Lock()
+        self.__probing = False
+
+    def ranked(self) -> List[str]:
+        """Returns all hosts, the healthy ones first and each group ordered by response time.
+           Hosts without measurements follow the measured ones in their configured order."""
+        with self.__lock:
+            return sorted(self.__hosts, key=lambda host: (not self.__is_healthy(host),
+                                                          self.__latency(host),
+                                                          self.__hosts.index(host)))
+
+    def __latency(self, host: str) -> float:
+        latency = self.__stats[host].latency
+        return float('inf') if latency is None else latency
+
+    def __is_healthy(self, host: str) -> bool:
+        stats = self.__stats[host]
+        return not stats.down and stats.error_rate < ERROR_THRESHOLD
+
+    def observe_result(self, host: str, success: bool):
+        """Record whether a request to the host succeeded"""
+        with self.__lock:
+            stats = self.__stats.get(host)
+            if stats is None:
+                return
+            stats.error_rate += SMOOTHING * ((0.0 if success else 1.0) - stats.error_rate)
+            if stats.down == success:
+                LOG.info("Apic host %s is %s", host, 'healthy again' if success else 'down')
+            stats.down = not success
+        HOST_ERROR_RATE.labels(host).set(stats.error_rate)
+
+    def observe_latency(self, host: str, seconds: float):
+        """Record the response time of a probe"""
+        with self.__lock:
+            stats = self.__stats.get(host)
+            if stats is None:
+                return
+            if stats.latency is None:
+                stats.latency = seconds
+            else:
+                stats.latency += SMOOTHING * (seconds - stats.latency)
+        HOST_LATENCY.labels(host).set(stats.latency)
+
+    def start_probing(self, probe: Callable[[str], None], interval: int = PROBE_INTERVAL):
+        """Probe every host every interval seconds in the background, starting immediately"""
+        with self.__lock:
+            if self.__probing:
+                return
+            self.__probing = True
+        thread = threading.Thread(target=self.__probe_loop, args=(probe, interval), name='probe', daemon=True)
+        thread.start()
+
+    def __probe_loop(self, probe: Callable[[str], None], interval: int):
+        while True:
+            for host in self.__hosts:
+                try:
+                    probe(host)
+                except Exception as e:
+                    LOG.error("Probing apic host %s failed: %s", host, e)
+            time.sleep(interval)
@@ -0,0 +1,45 @@
+import re
+
+from prometheus_client.core import Counter, Histogram, Summary
+
+QUERY_LABELS = ['collector', 'apicHost', 'class']
+QUERY_DURATION = Histogram('apic_exporter_query_duration_seconds',
+                           'Time until the APIC response of a query was received',
+                           QUERY_LABELS, buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+QUERY_RESPONSE_BYTES = Summary('apic_exporter_query_response_bytes',
+                               'Size of the APIC response body of a query',
+                               QUERY_LABELS)
+QUERY_OBJECTS = Summary('apic_exporter_query_objects',
+                        'Number of imdata objects returned by a query',
+                        QUERY_LABELS)
+QUERY_DECODE_SECONDS = Summary('apic_exporter_query_decode_seconds',
+                               'Time spent decoding the APIC response of a query',
+                               QUERY_LABELS)
+QUERY_TOKEN_RETRIES = Counter('apic_exporter_query_token_retries',
+                              'Queries retried after the APIC answered 403 for an invalid token',
+                              QUERY_LABELS)
+QUERY_TIMEOUTS = Counter('apic_exporter_query_timeouts',
+                         'Queries that timed out',
+                         QUERY_LABELS)
+SUBTREE_CLASS = re.compile(r'target-subtree-class=(\w+)')
+
+
+def query_class(query: str) -> str:
+    """The managed object class of a query, used as metric label.
+       Object queries are labelled by the rn prefix of the object, e.g. sys or HDprocProcMem5min"""
+    path, _, params = query.partition('?')
+    match = SUBTREE_CLASS.search(params)
+    if match is not None:
+        return match.group(1)
+    name = path.rsplit('/', 1)[-1].replace('.json', '')
+    if '/class/' in path:
+        return name
+    return name.split('-')[0]
+
+
+def observe_response(collector: str, host: str, query: str, size: int, objects: int, decode_seconds: float):
+    """Record size, object count and decode time of a received response"""
+    labels = (collector, host, query_class(query))
+    QUERY_RESPONSE_BYTES.labels(*labels).observe(size)
+    QUERY_OBJECTS.labels(*labels).observe(objects)
+    QUERY_DECODE_SECONDS.labels(*labels).observe(decode_seconds)
@@ -0,0 +1,40 @@
+import json
+import logging
+
+from typing import Callable, Dict, List, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LOG = logging.getLogger('apic_exporter.exporter')
+
+# decoders of raw response bodies by backend name, the first available one is the default
+BACKENDS: Dict[str, Callable[[Union[bytes, str]], object]] = {}
+if orjson is not None:
+    BACKENDS['orjson'] = orjson.loads
+BACKENDS['json'] = json.loads
+
+backend = next(iter(BACKENDS))
+_loads = BACKENDS[backend]
+
+
+def loads(data: Union[bytes, str]):
+    """Decodes a JSON document from the raw bytes of a response body without decoding them to str first.
+       Raises a ValueError (json.JSONDecodeError) on invalid documents with every backend."""
+    return _loads(data)
+
+
+def available_backends() -> List[str]:
+    return list(BACKENDS)
+
+
+def set_backend(name: str):
+    """Selects the backend by name, the default one is kept if it is not available"""
+    global backend, _loads
+    if name not in BACKENDS:
+        LOG.warning("JSON backend %s is not available, using %s", name, backend)
+        return
+    backend = name
+    _loads = BACKENDS[name]
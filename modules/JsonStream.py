@@ -0,0 +1,114 @@
+import codecs
+import json
+import logging
+import re
+import time
+
+from modules.Transport import IncompleteResponse
+from typing import Dict, Iterator
+
+LOG = logging.getLogger('apic_exporter.exporter')
+DECODER = json.JSONDecoder()
+IMDATA_START = re.compile(r'"imdata"\s*:\s*\[')
+TOTAL_COUNT = re.compile(r'"totalCount"\s*:\s*"?(\d+)')
+WHITESPACE = ' \t\n\r,'
+
+
+class ImdataStream(object):
+    def __init__(self, chunks: Iterator[bytes], on_close=None):
+        """Decodes the imdata objects of an APIC response one at a time from an iterator over raw chunks.
+           Iterating raises IncompleteResponse if reading the chunks fails or they end before the imdata list."""
+        self.__chunks = chunks
+        self.__on_close = on_close
+        self.__decoder = codecs.getincrementaldecoder('utf-8')()
+        self.__buffer = ''
+        self.__pos = 0
+        self.__eof = False
+        self.total_count = None
+        self.bytes_read = 0
+        self.objects = 0
+        self.decode_seconds = 0.0
+
+    def read_header(self) -> bool:
+        """Consume the response up to the start of the imdata list. Returns False if there is none"""
+        try:
+            return self.__read_header()
+        except IncompleteResponse as e:
+            LOG.error("%s", e)
+            return False
+
+    def __read_header(self) -> bool:
+        while True:
+            match = IMDATA_START.search(self.__buffer)
+            if match is not None:
+                count = TOTAL_COUNT.search(self.__buffer, 0, match.start())
+                if count is not None:
+                    self.total_count = count.group(1)
+                self.__pos = match.end()
+                return True
+            if not self.__read():
+                return False
+
+    def __read(self) -> bool:
+        """Append the next chunk to the buffer and drop what was already decoded"""
+        if self.__eof:
+            return False
+        try:
+            chunk = next(self.__chunks, None)
+        except Exception as e:
+            self.__eof = True
+            raise IncompleteResponse("Reading the response stream failed: %s" % e) from e
+        if chunk is None:
+            self.__eof = True
+            self.__buffer = self.__buffer[self.__pos:] + self.__decoder.decode(b'', final=True)
+            self.__pos = 0
+            return False
+        self.bytes_read += len(chunk)
+        self.__buffer = self.__buffer[self.__pos:] + self.__decoder.decode(chunk)
+        self.__pos = 0
+        return True
+
+    def __skip(self) -> str:
+        """Skip separators and return the next significant character or None at the end of the stream"""
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos] in WHITESPACE:
+                self.__pos += 1
+            if self.__pos < len(self.__buffer):
+                return self.__buffer[self.__pos]
+            if not self.__read():
+                return None
+
+    def __iter__(self) -> Iterator[Dict]:
+        try:
+            while True:
+                char = self.__skip()
+                if char is None:
+                    raise IncompleteResponse("Response stream ended inside imdata after %s objects" % self.objects)
+                if char == ']':
+                    return
+                # only retry decoding once the buffer has doubled, to stay linear on huge objects
+                needed = 0
+                while True:
+                    if self.__eof or len(self.__buffer) - self.__pos >= needed:
+                        start = time.perf_counter()
+                        try:
+                            item, end = DECODER.raw_decode(self.__buffer, self.__pos)
+                        except json.JSONDecodeError:
+                            self.decode_seconds += time.perf_counter() - start
+                            if self.__eof:
+                                raise IncompleteResponse("Response stream ended inside an imdata object")
+                            needed = 2 * (len(self.__buffer) - self.__pos)
+                        else:
+                            self.decode_seconds += time.perf_counter() - start
+                            break
+                    self.__read()
+                self.__pos = end
+                self.objects += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__on_close is not None:
+            self.__on_close()
+            self.__on_close = None
@@ -0,0 +1,56 @@
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.metrics_core import Metric
+from prometheus_client.samples import Sample
+from typing import Dict, List, Tuple
+
+
+class SeriesCache(object):
+    def __init__(self, name: str, documentation: str, labels: List[str], metric_type: str = 'gauge'):
+        """Keeps the samples of a metric family of a collector between scrapes. A series with the same
+           label values and value as in the previous scrape reuses its sample, so emitting unchanged
+           series allocates neither a sample nor a label dict. Series missing in a scrape are dropped."""
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.family_class = CounterMetricFamily if metric_type == 'counter' else GaugeMetricFamily
+        self.samples: Dict[Tuple[str, ...], Sample] = {}
+
+    def builder(self) -> 'FamilyBuilder':
+        """Starts building the family of a scrape"""
+        return FamilyBuilder(self)
+
+    def describe(self) -> Metric:
+        return self.family_class(self.name, self.documentation)
+
+
+class FamilyBuilder(object):
+    __slots__ = ('cache', 'metric', 'sample_name', 'previous', 'samples', 'series')
+
+    def __init__(self, cache: SeriesCache):
+        """Builds the family of a single scrape from the samples of the previous scrape"""
+        self.cache = cache
+        self.metric = cache.family_class(cache.name, cache.documentation, labels=cache.label_names)
+        # counter samples carry the _total suffix the family name is stripped of
+        self.sample_name = self.metric.name + '_total' if self.metric.type == 'counter' else self.metric.name
+        self.previous = cache.samples
+        self.samples: Dict[Tuple[str, ...], Sample] = {}
+        self.series = self.metric.samples
+
+    def add(self, labels: Tuple[str, ...], value: float):
+        """Adds a series, labels are the label values in the order of the label names"""
+        value = float(value)
+        sample = self.previous.get(labels)
+        if sample is None:
+            sample = Sample(self.sample_name, dict(zip(self.cache.label_names, labels)), value)
+        elif sample.value != value:
+            sample = Sample(self.sample_name, sample.labels, value)
+        self.samples[labels] = sample
+        self.series.append(sample)
+
+    def __len__(self) -> int:
+        return len(self.series)
+
+    def build(self) -> Metric:
+        """Returns the family and keeps its samples for the next scrape"""
+        self.cache.samples = self.samples
+        return self.metric
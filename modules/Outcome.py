@@ -0,0 +1,21 @@
+import contextvars
+
+
+class Outcome(object):
+    def __init__(self):
+        """Whether a collection is incomplete, e.g. because no APIC host answered or its deadline ran out.
+           Set up by the caller of the collection that decides what to do with incomplete results."""
+        self.incomplete = False
+        self.reason: str = None
+
+
+OUTCOME: contextvars.ContextVar = contextvars.ContextVar('apic_exporter_outcome', default=None)
+
+
+def mark_incomplete(reason: str):
+    """Flags the current collection incomplete, the first reason is kept"""
+    outcome = OUTCOME.get()
+    if outcome is None or outcome.incomplete:
+        return
+    outcome.incomplete = True
+    outcome.reason = reason
@@ -0,0 +1,21 @@
+import functools
+import threading
+
+from typing import List
+
+
+def per_fabric(cls):
+    """Class decorator like singleton, but with one instance per fabric. The fabric is identified by its
+       APIC hosts, which are the first argument of the constructor, regardless of their order. Later calls
+       for the same hosts return the existing instance and ignore the other arguments."""
+    instances = {}
+    lock = threading.Lock()
+
+    @functools.wraps(cls, updated=())
+    def get_instance(hosts: List[str], *args, **kwargs):
+        key = frozenset(hosts)
+        with lock:
+            if key not in instances:
+                instances[key] = cls(hosts, *args, **kwargs)
+            return instances[key]
+    return get_instance
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from prometheus_client import REGISTRY, CollectorRegistry, make_wsgi_app
+from prometheus_client.core import Summary
+from prometheus_client.exposition import ThreadingWSGIServer
+from modules.WorkerPool import ParallelCollector
+
+from typing import Dict, List
+
+LOG = logging.getLogger('apic_exporter.exporter')
+PROBE_DURATION = Summary('apic_exporter_probe_duration_seconds',
+                         'Time spent serving a probe of a fabric',
+                         ['target'])
+
+
+class FabricTarget(object):
+    def __init__(self, name: str, collectors: Dict, workers: int = 1):
+        """The collectors of a fabric served by /probe. They run on the fabric's own thread pool of workers"""
+        self.name = name
+        self.names = list(collectors)
+        self.__collectors = ParallelCollector(collectors, workers)
+
+    def registry(self, names: List[str]) -> CollectorRegistry:
+        """A registry of the named collectors, all collectors if names is empty"""
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(self.__collectors.select(names or self.names))
+        return registry
+
+
+class SilentHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        """Probes are not logged per request"""
+        pass
+
+
+def make_probe_app(targets: Dict[str, FabricTarget]):
+    """Serves /probe?target=<fabric>&collectors=<name>,... from the fabric's collectors and everything else,
+       e.g. the exporter's own metrics, from the default registry"""
+    metrics_app = make_wsgi_app(REGISTRY)
+
+    def bad_request(start_response, message: str):
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return [message.encode('utf-8')]
+
+    def app(environ, start_response):
+        if environ['PATH_INFO'] != '/probe':
+            return metrics_app(environ, start_response)
+
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        name = params.get('target', [''])[0]
+        target = targets.get(name)
+        if target is None:
+            return bad_request(start_response, "Unknown target '%s'\n" % name)
+        names = [c for value in params.get('collectors', []) for c in value.split(',') if c]
+        unknown = [c for c in names if c not in target.names]
+        if unknown:
+            return bad_request(start_response, "Unknown collectors %s for target %s\n" % (', '.join(unknown), name))
+
+        start = time.perf_counter()
+        response = make_wsgi_app(target.registry(names))(environ, start_response)
+        PROBE_DURATION.labels(name).observe(time.perf_counter() - start)
+        return response
+    return app
+
+
+def start_probe_server(port: int, targets: Dict[str, FabricTarget], addr: str = '0.0.0.0'):
+    """Starts the probe server in a daemon thread"""
+    httpd = make_server(addr, port, make_probe_app(targets), ThreadingWSGIServer, handler_class=SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name='probe-server', daemon=True)
+    thread.start()
+    LOG.info("Serving %s fabrics on /probe", len(targets))
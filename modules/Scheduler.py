@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Dict, List, Tuple
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.metrics_core import Metric
+from modules.Outcome import OUTCOME, Outcome
+
+LOG = logging.getLogger('apic_exporter.exporter')
+COLLECTION_INTERVAL = 60
+
+
+class CollectorSnapshot(object):
+    def __init__(self, metrics: List[Metric] = None, timestamp: float = None, failed: bool = False):
+        """Last complete result set of a collector and the time it was taken"""
+        self.metrics: List[Metric] = metrics if metrics is not None else []
+        self.timestamp = timestamp
+        self.failed = failed
+
+
+class CachedCollector(object):
+    def __init__(self, name: str, collector, interval: int = 0, timeout: int = None):
+        """Runs the collector at most every interval seconds and serves the last snapshot in between.
+           A run that takes longer than timeout seconds continues in the background while the previous
+           snapshot is served."""
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.snapshot = CollectorSnapshot()
+        self.__collector = collector
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='collect-' + name)
+        self.__running: Future = None
+        self.__lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """Start a run unless one is in progress and wait up to timeout for it.
+           Returns whether the run completed in time."""
+        with self.__lock:
+            if self.__running is None or self.__running.done():
+                self.__running = self.__executor.submit(self.__run)
+            running = self.__running
+        try:
+            running.result(timeout=self.timeout)
+            return True
+        except TimeoutError:
+            LOG.warning("Collector %s did not finish within %s sec, keeping previous snapshot",
+                        self.name, self.timeout)
+            return False
+
+    def __run(self):
+        """Run the collector and replace the snapshot if the run completed. An incomplete run, e.g. without
+           any APIC host answering, keeps the previous snapshot unless there is none yet."""
+        outcome = Outcome()
+        token = OUTCOME.set(outcome)
+        try:
+            metrics = list(self.__collector.collect())
+        except Exception as e:
+            LOG.error("Collector %s failed, keeping previous snapshot: %s", self.name, e)
+            self.snapshot = CollectorSnapshot(self.snapshot.metrics, self.snapshot.timestamp, failed=True)
+            return
+        finally:
+            OUTCOME.reset(token)
+        if outcome.incomplete:
+            LOG.warning("Collector %s is incomplete, keeping previous snapshot: %s", self.name, outcome.reason)
+            if self.snapshot.timestamp is not None:
+                metrics = self.snapshot.metrics
+            self.snapshot = CollectorSnapshot(metrics, self.snapshot.timestamp, failed=True)
+            return
+        self.snapshot = CollectorSnapshot(metrics, time.time())
+
+    def describe(self):
+        return self.__collector.describe()
+
+    def collect(self):
+        """Yields the snapshot, which is refreshed first if it is older than the interval"""
+        snapshot = self.snapshot
+        if snapshot.timestamp is None or time.time() - snapshot.timestamp >= self.interval:
+            self.refresh()
+        for metric in self.snapshot.metrics:
+            yield metric
+
+
+class CollectorScheduler(object):
+    def __init__(self, collectors: Dict[str, CachedCollector]):
+        """Refreshes every collector in the background on its own interval and serves the last complete
+           result set on collect. The age and staleness of the snapshots are served by status."""
+        self.__collectors = collectors
+        self.__stop = threading.Event()
+        self.__threads: List[threading.Thread] = []
+        self.status = SchedulerStatus(collectors)
+
+    def start(self):
+        """Start one scheduling thread per collector"""
+        for name, collector in self.__collectors.items():
+            thread = threading.Thread(target=self.__run, args=(collector,),
+                                      name='schedule-' + name, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        self.__stop.set()
+
+    def __run(self, collector: CachedCollector):
+        """Refresh in a loop on the collector's interval until stopped"""
+        while not self.__stop.is_set():
+            start = time.monotonic()
+            collector.refresh()
+            elapsed = time.monotonic() - start
+            self.__stop.wait(max(0, collector.interval - elapsed))
+
+    def version(self) -> Tuple[CollectorSnapshot, ...]:
+        """The current snapshots, which are replaced by every run. Snapshots compare by identity."""
+        return tuple(collector.snapshot for collector in self.__collectors.values())
+
+    def describe(self):
+        for collector in self.__collectors.values():
+            yield from collector.describe()
+
+    def collect(self):
+        """Yields the cached snapshots"""
+        for collector in self.__collectors.values():
+            yield from collector.snapshot.metrics
+
+
+class SchedulerStatus(object):
+    def __init__(self, collectors: Dict[str, CachedCollector]):
+        """Age and staleness of the snapshots of the scheduled collectors"""
+        self.__collectors = collectors
+
+    def describe(self):
+        yield GaugeMetricFamily('apic_exporter_collector_snapshot_age_seconds',
+                                'Age of the last complete collector snapshot')
+        yield GaugeMetricFamily('apic_exporter_collector_stale',
+                                'Collector snapshot is older than two collection intervals or the last run failed')
+
+    def collect(self):
+        g_age = GaugeMetricFamily('apic_exporter_collector_snapshot_age_seconds',
+                                  'Age of the last complete collector snapshot',
+                                  labels=['collector'])
+        g_stale = GaugeMetricFamily('apic_exporter_collector_stale',
+                                    'Collector snapshot is older than two collection intervals or the last run failed',
+                                    labels=['collector'])
+
+        now = time.time()
+        for name, collector in self.__collectors.items():
+            snapshot = collector.snapshot
+            if snapshot.timestamp is None:
+                g_stale.add_metric(labels=[name], value=1)
+                continue
+            age = now - snapshot.timestamp
+            stale = snapshot.failed or age > 2 * collector.interval
+            g_age.add_metric(labels=[name], value=age)
+            g_stale.add_metric(labels=[name], value=1 if stale else 0)
+
+        yield g_age
+        yield g_stale
@@ -0,0 +1,45 @@
+import threading
+
+from typing import Callable, Dict, Hashable, Tuple
+
+
+class InFlightCall(object):
+    def __init__(self):
+        """Result of a call that concurrent callers with the same key wait for"""
+        self.done = threading.Event()
+        self.result = None
+        self.error: Exception = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        """Executes concurrent calls with the same key only once and shares the result"""
+        self.__lock = threading.Lock()
+        self.__calls: Dict[Hashable, InFlightCall] = {}
+
+    def do(self, key: Hashable, fn: Callable, *args) -> Tuple[object, bool]:
+        """Calls fn unless a call with the same key is in flight, in which case its result is awaited.
+           Returns the result and whether it was shared with another caller"""
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = InFlightCall()
+                self.__calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+        return call.result, False
@@ -0,0 +1,202 @@
+import aiohttp
+import asyncio
+import logging
+import threading
+import time
+
+from modules import JsonDecoder
+from modules.PerFabric import per_fabric
+from modules.AsyncConnection import AsyncConnection
+
+from typing import List, Dict
+
+LOG = logging.getLogger('apic_exporter.exporter')
+SUBSCRIPTION_REFRESH = 30
+SUBSCRIPTION_RESYNC = 600
+RECONNECT_DELAY = 10
+
+
+def parent_dn(dn: str) -> str:
+    """Strips the last rn of the dn. Slashes inside brackets, e.g. of ip-[10.0.0.0/24], are part of the rn"""
+    depth = 0
+    for i in range(len(dn) - 1, -1, -1):
+        if dn[i] == ']':
+            depth += 1
+        elif dn[i] == '[':
+            depth -= 1
+        elif dn[i] == '/' and depth == 0:
+            return dn[:i]
+    return ''
+
+
+class SubscriptionStore(object):
+    def __init__(self, query: str):
+        """Objects of a subscribed query by dn, kept up to date by the pushed events"""
+        self.query = query
+        self.host: str = None
+        self.subscription_id: str = None
+        self.timestamp: float = None
+        self.__objects: Dict[str, Dict] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def synced(self) -> bool:
+        return self.timestamp is not None
+
+    def replace(self, host: str, subscription_id: str, imdata: List[Dict]):
+        """Replace all objects with the result of the subscription query"""
+        objects = {}
+        for item in imdata:
+            for mo_class, mo in item.items():
+                dn = mo['attributes']['dn']
+                children = {}
+                for child in mo.get('children', []):
+                    for child_class, child_mo in child.items():
+                        child_dn = child_mo['attributes'].get('dn') or dn + '/' + child_mo['attributes']['rn']
+                        children[child_dn] = {child_class: {'attributes': child_mo['attributes']}}
+                objects[dn] = {'class': mo_class, 'attributes': mo['attributes'], 'children': children}
+        with self.__lock:
+            self.__objects = objects
+            self.host = host
+            self.subscription_id = subscription_id
+            self.timestamp = time.monotonic()
+        LOG.info("Subscribed %s objects of %s on %s", len(objects), self.query, host)
+
+    def apply(self, imdata: List[Dict]):
+        """Apply the created, modified and deleted events to the stored objects and their children"""
+        with self.__lock:
+            for item in imdata:
+                for mo_class, mo in item.items():
+                    attributes = mo['attributes']
+                    dn = attributes['dn']
+                    status = attributes.get('status', 'modified')
+                    if dn in self.__objects:
+                        self.__apply_object(dn, mo_class, attributes, status)
+                    elif parent_dn(dn) in self.__objects:
+                        children = self.__objects[parent_dn(dn)]['children']
+                        self.__apply_child(children, dn, mo_class, attributes, status)
+                    elif status == 'created':
+                        self.__apply_object(dn, mo_class, attributes, status)
+
+    def __apply_object(self, dn: str, mo_class: str, attributes: Dict, status: str):
+        if status == 'deleted':
+            self.__objects.pop(dn, None)
+        elif dn in self.__objects:
+            self.__objects[dn]['attributes'] = dict(self.__objects[dn]['attributes'], **attributes)
+        else:
+            self.__objects[dn] = {'class': mo_class, 'attributes': attributes, 'children': {}}
+
+    def __apply_child(self, children: Dict, dn: str, mo_class: str, attributes: Dict, status: str):
+        if status == 'deleted':
+            children.pop(dn, None)
+        elif dn in children:
+            child_attributes = children[dn][mo_class]['attributes']
+            children[dn] = {mo_class: {'attributes': dict(child_attributes, **attributes)}}
+        else:
+            children[dn] = {mo_class: {'attributes': attributes}}
+
+    def reset(self):
+        """Flag the store as out of sync, e.g. after the websocket was closed"""
+        self.timestamp = None
+        self.subscription_id = None
+
+    def get_page(self) -> Dict:
+        """Returns the stored objects in the shape of a fetched page"""
+        with self.__lock:
+            imdata = []
+            for mo in self.__objects.values():
+                obj = {'attributes': mo['attributes']}
+                if mo['children']:
+                    obj['children'] = list(mo['children'].values())
+                imdata.append({mo['class']: obj})
+        return {'totalCount': str(len(imdata)), 'imdata': imdata}
+
+
+@per_fabric
+class SubscriptionManager(object):
+    def __init__(self, hosts: List[str], connection: AsyncConnection, resync: int = SUBSCRIPTION_RESYNC):
+        """Keeps the subscribed queries up to date through the APIC websocket of the first available host.
+           Subscriptions are refreshed every SUBSCRIPTION_REFRESH seconds and fully re-synchronized
+           every resync seconds."""
+        self.__hosts = hosts
+        self.__connection = connection
+        self.__resync = resync
+        self.__stores: Dict[str, SubscriptionStore] = {}
+        self.__lock = threading.Lock()
+        self.__task = None
+
+    def subscribe(self, query: str) -> SubscriptionStore:
+        """Returns the store of the query and starts listening for events on first use"""
+        with self.__lock:
+            if query not in self.__stores:
+                self.__stores[query] = SubscriptionStore(query)
+            if self.__task is None:
+                self.__task = self.__connection.start(self.__run())
+            return self.__stores[query]
+
+    async def __run(self):
+        while True:
+            for host in list(self.__hosts):
+                try:
+                    await self.__listen(host)
+                except Exception as e:
+                    LOG.error("Subscriptions on %s failed: %s", host, e)
+                for store in list(self.__stores.values()):
+                    store.reset()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def __listen(self, host: str):
+        """Dispatch the events of the host's websocket until it is closed"""
+        ws = await self.__connection.openWebsocket(host)
+        if ws is None:
+            return
+
+        LOG.info("Listening for subscription events on %s", host)
+        maintenance = asyncio.ensure_future(self.__maintain(host))
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    self.__dispatch(JsonDecoder.loads(msg.data))
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    LOG.error("Websocket of %s failed: %s", host, ws.exception())
+                    break
+        finally:
+            maintenance.cancel()
+            await ws.close()
+        LOG.warning("Websocket of %s was closed", host)
+
+    async def __maintain(self, host: str):
+        """Subscribe new or outdated stores and refresh the others before the APIC drops them"""
+        while True:
+            for store in list(self.__stores.values()):
+                try:
+                    await self.__maintain_store(host, store)
+                except Exception as e:
+                    # an unsynced store is subscribed again in the next round, collectors poll meanwhile
+                    LOG.error("Maintaining the subscription of %s on %s failed: %s", store.query, host, e)
+                    store.reset()
+            await asyncio.sleep(SUBSCRIPTION_REFRESH)
+
+    async def __maintain_store(self, host: str, store: SubscriptionStore):
+        if not store.synced or time.monotonic() - store.timestamp > self.__resync:
+            await self.__subscribe(host, store)
+            return
+        refresh = await self.__connection.getRequest(
+            host, '/api/subscriptionRefresh.json?id=' + store.subscription_id)
+        if refresh is None:
+            LOG.warning("Refreshing subscription of %s on %s failed", store.query, host)
+            store.reset()
+
+    async def __subscribe(self, host: str, store: SubscriptionStore):
+        separator = '&' if '?' in store.query else '?'
+        fetched_data = await self.__connection.getRequest(host, store.query + separator + 'subscription=yes')
+        if not self.__connection.isDataValid(fetched_data) or 'subscriptionId' not in fetched_data:
+            LOG.warning("Apic host %s did not accept the subscription of %s", host, store.query)
+            return
+        store.replace(host, fetched_data['subscriptionId'], fetched_data['imdata'])
+
+    def __dispatch(self, event: Dict):
+        subscription_ids = event.get('subscriptionId', [])
+        for store in list(self.__stores.values()):
+            if store.subscription_id in subscription_ids:
+                store.apply(event.get('imdata', []))
@@ -0,0 +1,76 @@
+import logging
+import re
+import threading
+import time
+
+from modules.PerFabric import per_fabric
+from typing import List, Dict
+from collections import namedtuple
+
+LOG = logging.getLogger('apic_exporter.exporter')
+TOPOLOGY_TTL = 300
+fabric_node = namedtuple('fabric_node', 'id role model pod dn')
+
+
+@per_fabric
+class TopologyCache(object):
+    def __init__(self, hosts: List[str], connection, ttl: int = TOPOLOGY_TTL, refresh: bool = False):
+        """Caches the fabricNode objects of the fabric for ttl seconds.
+           Optionally refreshes them in the background before they expire."""
+        self.__hosts = hosts
+        self.__connection = connection
+        self.__ttl = ttl
+        self.__nodes: List[fabric_node] = []
+        self.__timestamp: float = None
+        self.__lock = threading.Lock()
+
+        if refresh:
+            thread = threading.Thread(target=self.__refresh_loop, name='topology', daemon=True)
+            thread.start()
+
+    def get_nodes(self, host: str, role: str = None) -> List[fabric_node]:
+        """Returns the cached fabric nodes, optionally filtered by role.
+           Expired nodes are fetched from the given host. Returns None if the host did not respond."""
+        with self.__lock:
+            if self.__timestamp is None or time.monotonic() - self.__timestamp > self.__ttl:
+                if not self.__refresh(host):
+                    return None
+            nodes = self.__nodes
+        if role is None:
+            return nodes
+        return [node for node in nodes if node.role == role]
+
+    def invalidate(self):
+        """Forces the next get_nodes to fetch the nodes again"""
+        LOG.debug("Invalidate fabric topology")
+        with self.__lock:
+            self.__timestamp = None
+
+    def __refresh_loop(self):
+        while True:
+            time.sleep(self.__ttl / 2)
+            with self.__lock:
+                for host in self.__hosts:
+                    try:
+                        if self.__refresh(host):
+                            break
+                    except Exception as e:
+                        LOG.error("Refreshing the fabric topology from %s failed: %s", host, e)
+
+    def __refresh(self, host: str) -> bool:
+        """Fetch all fabric nodes from the host"""
+        query = '/api/node/class/fabricNode.json?order-by=fabricNode.id|asc'
+        fetched_data = self.__connection.getRequest(host, query)
+        if not self.__connection.isDataValid(fetched_data):
+            LOG.warning("Apic host %s did not return the fabric topology", host)
+            return False
+
+        self.__nodes = [self.__parse_node(node['fabricNode']['attributes']) for node in fetched_data['imdata']]
+        self.__timestamp = time.monotonic()
+        LOG.debug("Fetched %s fabric nodes from %s", len(self.__nodes), host)
+        return True
+
+    def __parse_node(self, attributes: Dict) -> fabric_node:
+        matchObj = re.match(r"topology/pod-([0-9]+)/", attributes['dn'])
+        return fabric_node(id=attributes['id'], role=attributes['role'], model=attributes['model'],
+                           pod=matchObj.group(1) if matchObj else '', dn=attributes['dn'])
@@ -0,0 +1,86 @@
+import zlib
+
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPSConnectionPool
+from prometheus_client.core import Counter
+
+CONNECTION_POOL_SIZE = 16
+CONNECTIONS_OPENED = Counter('apic_exporter_connections_opened',
+                             'Connections to the APIC opened with a new TLS handshake',
+                             ['apicHost', 'transport'])
+CONNECTIONS_REUSED = Counter('apic_exporter_connections_reused',
+                             'Requests sent on an already established keep-alive connection to the APIC',
+                             ['apicHost', 'transport'])
+WIRE_BYTES = Counter('apic_exporter_response_wire_bytes',
+                     'Bytes of APIC response bodies as transferred, compressed if the APIC compressed them',
+                     ['apicHost', 'transport'])
+DECODED_BYTES = Counter('apic_exporter_response_decoded_bytes',
+                        'Bytes of APIC response bodies after decompression',
+                        ['apicHost', 'transport'])
+
+
+class IncompleteResponse(IOError):
+    """An APIC response that broke off after a part of it was handed to the caller, hence the caller has to
+       drop what it received from the host"""
+
+
+def accept_encoding(compression: bool) -> str:
+    return 'gzip' if compression else 'identity'
+
+
+def observe_transfer(host: str, transport: str, wire_bytes: int, decoded_bytes: int):
+    WIRE_BYTES.labels(host, transport).inc(wire_bytes)
+    DECODED_BYTES.labels(host, transport).inc(decoded_bytes)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    apic_host = ''
+
+    def _validate_conn(self, conn):
+        """Counts whether the request opens a new connection or reuses a kept-alive one"""
+        opened = conn.is_closed if hasattr(conn, 'is_closed') else conn.sock is None
+        super()._validate_conn(conn)
+        counter = CONNECTIONS_OPENED if opened else CONNECTIONS_REUSED
+        counter.labels(self.apic_host, 'sync').inc()
+
+
+class APICAdapter(HTTPAdapter):
+    def __init__(self, host: str, pool_size: int = CONNECTION_POOL_SIZE):
+        """Keeps up to pool_size connections to a single APIC host alive and counts their reuse. Requests
+           beyond pool_size do not wait, but their connections are closed instead of being kept."""
+        self.__host = host
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        pool_class = type('CountingHTTPSConnectionPool', (CountingHTTPSConnectionPool,), {'apic_host': self.__host})
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme, https=pool_class)
+
+
+def decompress(host: str, body: bytes, encoding: str) -> bytes:
+    """Decompresses the body of an asyncio transport response, which is read as transferred"""
+    if encoding == 'gzip':
+        data = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        data = zlib.decompress(body)
+    else:
+        data = body
+    observe_transfer(host, 'async', len(body), len(data))
+    return data
+
+
+def connection_trace() -> aiohttp.TraceConfig:
+    """Counts opened and reused connections of asyncio requests passing their host as trace_request_ctx"""
+    async def on_create(session, context, params):
+        if context.trace_request_ctx is not None:
+            CONNECTIONS_OPENED.labels(context.trace_request_ctx, 'async').inc()
+
+    async def on_reuse(session, context, params):
+        if context.trace_request_ctx is not None:
+            CONNECTIONS_REUSED.labels(context.trace_request_ctx, 'async').inc()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_create)
+    trace.on_connection_reuseconn.append(on_reuse)
+    return trace
@@ -0,0 +1,64 @@
+import copy
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from prometheus_client.metrics_core import Metric
+
+LOG = logging.getLogger('apic_exporter.exporter')
+
+
+def run_collector(collector) -> List[Metric]:
+    """Run a collector to completion and return its metric families"""
+    return list(collector.collect())
+
+
+def merge_metrics(results: List[List[Metric]]) -> List[Metric]:
+    """Merge metric families of the same name produced by different collectors. The families of the
+       collectors are left untouched, they may be cached snapshots served again on later scrapes."""
+    merged: Dict[str, Metric] = {}
+    copied = set()
+    for metrics in results:
+        for metric in metrics:
+            if metric.name not in merged:
+                merged[metric.name] = metric
+                continue
+            if metric.name not in copied:
+                family = copy.copy(merged[metric.name])
+                family.samples = list(family.samples)
+                merged[metric.name] = family
+                copied.add(metric.name)
+            merged[metric.name].samples.extend(metric.samples)
+    return list(merged.values())
+
+
+class ParallelCollector(object):
+    def __init__(self, collectors: Dict, workers: int, executor: ThreadPoolExecutor = None):
+        """Runs the collectors concurrently on a thread pool of the given size on every scrape"""
+        self.__collectors = collectors
+        self.__executor = executor or ThreadPoolExecutor(max_workers=workers,
+                                                         thread_name_prefix='collector')
+
+    def select(self, names: List[str]) -> 'ParallelCollector':
+        """Returns a collector running only the named collectors on the same thread pool"""
+        return ParallelCollector({name: c for name, c in self.__collectors.items() if name in names},
+                                 0, self.__executor)
+
+    def describe(self):
+        for collector in self.__collectors.values():
+            yield from collector.describe()
+
+    def collect(self):
+        """Submit every collector to the pool and yield the merged metric families"""
+        futures = [(name, self.__executor.submit(run_collector, collector))
+                   for name, collector in self.__collectors.items()]
+
+        results = []
+        for name, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                LOG.error("Collector %s failed: %s", name, e)
+
+        for metric in merge_metrics(results):
+            yield metric